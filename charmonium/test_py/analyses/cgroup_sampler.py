@@ -0,0 +1,273 @@
+from __future__ import annotations
+import contextlib
+import dataclasses
+import datetime
+import pathlib
+import threading
+import warnings
+from typing import Generator, Optional
+
+
+cgroup_root = pathlib.Path("/sys/fs/cgroup")
+
+
+@dataclasses.dataclass(frozen=True)
+class ResourceSample:
+    time: datetime.timedelta
+    cpu_time: datetime.timedelta
+    memory: int
+    io_bytes_read: int | None
+    io_bytes_written: int | None
+
+
+@dataclasses.dataclass(frozen=True)
+class CgroupUsage:
+    user_cpu_time: datetime.timedelta
+    system_cpu_time: datetime.timedelta
+    wall_time: datetime.timedelta
+    max_memory: int
+    max_virtual_memory_size: int | None
+    io_bytes_read: int | None
+    io_bytes_written: int | None
+    scheduler_context_switches: int | None
+    time_series: tuple[ResourceSample, ...]
+
+
+@dataclasses.dataclass(frozen=True)
+class _RawSample:
+    time: datetime.datetime
+    user_usec: int
+    system_usec: int
+    memory_current: int
+    memory_peak: int | None
+    io_rbytes: int | None
+    io_wbytes: int | None
+    virtual_memory_size: int | None
+    context_switches: dict[int, int]
+
+
+def find_container_cgroup(container_id: str) -> Optional[pathlib.Path]:
+    """Find the cgroup (v2) of a Docker container, for either the systemd or the cgroupfs cgroup driver."""
+    for candidate in [
+            cgroup_root / "system.slice" / f"docker-{container_id}.scope",
+            cgroup_root / "docker" / container_id,
+    ]:
+        if (candidate / "cpu.stat").exists():
+            return candidate
+    return None
+
+
+def _read_flat_keyed(path: pathlib.Path) -> dict[str, int]:
+    return {
+        key: int(val)
+        for key, val in (line.split(" ") for line in path.read_text().strip().split("\n") if line)
+    }
+
+
+def _read_io_stat(path: pathlib.Path) -> tuple[int, int] | None:
+    # Lines look like "8:0 rbytes=1 wbytes=2 rios=3 wios=4 dbytes=0 dios=0"
+    if not path.exists():
+        return None
+    rbytes = 0
+    wbytes = 0
+    for line in path.read_text().strip().split("\n"):
+        for field in line.split(" ")[1:]:
+            key, _, val = field.partition("=")
+            if key == "rbytes":
+                rbytes += int(val)
+            elif key == "wbytes":
+                wbytes += int(val)
+    return rbytes, wbytes
+
+
+def _read_procs(cgroup: pathlib.Path) -> tuple[int | None, dict[int, int]]:
+    """Total virtual memory size and per-process context switches of the processes in the cgroup.
+
+    Returns None for the virtual memory size if we cannot see any of the processes (e.g., they are in another PID namespace).
+
+    """
+    virtual_memory_size: int | None = None
+    context_switches: dict[int, int] = {}
+    for pid_str in (cgroup / "cgroup.procs").read_text().split():
+        try:
+            status = pathlib.Path(f"/proc/{pid_str}/status").read_text()
+        except OSError:
+            continue
+        fields = dict(
+            line.split(":", 1)
+            for line in status.split("\n")
+            if ":" in line
+        )
+        if "VmSize" in fields:
+            virtual_memory_size = (virtual_memory_size or 0) + int(fields["VmSize"].split()[0]) * 1024
+        context_switches[int(pid_str)] = (
+            int(fields.get("voluntary_ctxt_switches", 0))
+            + int(fields.get("nonvoluntary_ctxt_switches", 0))
+        )
+    return virtual_memory_size, context_switches
+
+
+def _read_sample(cgroup: pathlib.Path) -> _RawSample:
+    cpu_stat = _read_flat_keyed(cgroup / "cpu.stat")
+    io_stat = _read_io_stat(cgroup / "io.stat")
+    memory_peak_path = cgroup / "memory.peak"
+    virtual_memory_size, context_switches = _read_procs(cgroup)
+    return _RawSample(
+        time=datetime.datetime.now(),
+        user_usec=cpu_stat["user_usec"],
+        system_usec=cpu_stat["system_usec"],
+        memory_current=int((cgroup / "memory.current").read_text()),
+        memory_peak=int(memory_peak_path.read_text()) if memory_peak_path.exists() else None,
+        io_rbytes=io_stat[0] if io_stat is not None else None,
+        io_wbytes=io_stat[1] if io_stat is not None else None,
+        virtual_memory_size=virtual_memory_size,
+        context_switches=context_switches,
+    )
+
+
+class CgroupSampler:
+    """Samples a running container's cgroup every interval, in a background thread.
+
+    Counters are reported relative to when sampling began, so this works for a command exec'ed in an already-running container,
+    unless the watched command is the whole container, in which case they are absolute.
+    Container-lifetime counters can only be read while the container is running (its cgroup goes away when it exits),
+    so the container should outlive the watch (see `measure_docker_execution`).
+    At most time_series_length samples are kept in the time series;
+    when it fills up, every other sample gets dropped, and the rest are taken half as often.
+
+    """
+
+    def __init__(
+            self,
+            interval: datetime.timedelta = datetime.timedelta(seconds=1),
+            time_series_length: int = 0,
+    ) -> None:
+        self.interval = interval
+        self.time_series_length = time_series_length
+        self._samples: list[_RawSample] = []
+        self._time_series: list[_RawSample] = []
+        self._stride = 1
+        self._n_samples = 0
+        self._max_memory = 0
+        self._max_virtual_memory_size: int | None = None
+        self._context_switches: dict[int, int] = {}
+        self._whole_container = False
+        self._baseline: _RawSample | None = None
+
+    @contextlib.contextmanager
+    def watch(self, container_id: str, whole_container: bool) -> Generator[None, None, None]:
+        """Sample container_id's cgroup within this context.
+
+        whole_container means the container runs nothing but the watched command,
+        so container-lifetime counters (memory.peak) apply to the command.
+
+        """
+        cgroup = find_container_cgroup(container_id)
+        if cgroup is None:
+            warnings.warn(f"Could not find the cgroup of container {container_id}; not sampling its resources")
+            yield
+            return
+        self._whole_container = whole_container
+        if whole_container:
+            # The container started just now, so its counters started from 0 just now.
+            self._baseline = _RawSample(
+                time=datetime.datetime.now(),
+                user_usec=0,
+                system_usec=0,
+                memory_current=0,
+                memory_peak=None,
+                io_rbytes=0,
+                io_wbytes=0,
+                virtual_memory_size=None,
+                context_switches={},
+            )
+        stop = threading.Event()
+        def sample_until_stopped() -> None:
+            while not stop.wait(self.interval.total_seconds()):
+                self._try_sample(cgroup)
+        self._try_sample(cgroup)
+        thread = threading.Thread(target=sample_until_stopped, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+            # The cgroup is gone if the container already exited, in which case we keep the last sample.
+            self._try_sample(cgroup)
+
+    def _try_sample(self, cgroup: pathlib.Path) -> None:
+        try:
+            sample = _read_sample(cgroup)
+        except (OSError, KeyError, ValueError):
+            return
+        if not self._samples:
+            self._samples.append(sample)
+        else:
+            self._samples[1:] = [sample]
+        self._max_memory = max(self._max_memory, sample.memory_current)
+        if self._whole_container and sample.memory_peak is not None:
+            self._max_memory = max(self._max_memory, sample.memory_peak)
+        if sample.virtual_memory_size is not None:
+            self._max_virtual_memory_size = max(self._max_virtual_memory_size or 0, sample.virtual_memory_size)
+        # Context switch counts only go up, so the latest count of each process is its max.
+        self._context_switches.update(sample.context_switches)
+        if self.time_series_length:
+            if self._n_samples % self._stride == 0:
+                self._time_series.append(sample)
+                if len(self._time_series) > self.time_series_length:
+                    self._time_series = self._time_series[::2]
+                    self._stride *= 2
+            self._n_samples += 1
+
+    def usage(self) -> Optional[CgroupUsage]:
+        """Resource usage between the first sample (or the start of a whole container) and the last one, or None if no samples were taken."""
+        if not self._samples:
+            return None
+        first = self._baseline if self._baseline is not None else self._samples[0]
+        last = self._samples[-1]
+        return CgroupUsage(
+            user_cpu_time=datetime.timedelta(microseconds=last.user_usec - first.user_usec),
+            system_cpu_time=datetime.timedelta(microseconds=last.system_usec - first.system_usec),
+            wall_time=last.time - first.time,
+            max_memory=self._max_memory,
+            max_virtual_memory_size=self._max_virtual_memory_size,
+            io_bytes_read=(
+                last.io_rbytes - first.io_rbytes
+                if last.io_rbytes is not None and first.io_rbytes is not None
+                else None
+            ),
+            io_bytes_written=(
+                last.io_wbytes - first.io_wbytes
+                if last.io_wbytes is not None and first.io_wbytes is not None
+                else None
+            ),
+            scheduler_context_switches=(
+                sum(
+                    count - first.context_switches.get(pid, 0)
+                    for pid, count in self._context_switches.items()
+                )
+                if self._context_switches
+                else None
+            ),
+            time_series=tuple(
+                ResourceSample(
+                    time=sample.time - first.time,
+                    cpu_time=datetime.timedelta(
+                        microseconds=sample.user_usec + sample.system_usec - first.user_usec - first.system_usec
+                    ),
+                    memory=sample.memory_current,
+                    io_bytes_read=(
+                        sample.io_rbytes - first.io_rbytes
+                        if sample.io_rbytes is not None and first.io_rbytes is not None
+                        else None
+                    ),
+                    io_bytes_written=(
+                        sample.io_wbytes - first.io_wbytes
+                        if sample.io_wbytes is not None and first.io_wbytes is not None
+                        else None
+                    ),
+                )
+                for sample in self._time_series
+            ),
+        )
@@ -6,17 +6,18 @@ import shlex
 import shutil
 from typing import Mapping
 
-from ..types import Analysis, Code, Condition, Result
-from ..util import create_temp_dir, expect_type, mtime, walk_files, chown
+from ..types import Analysis, Code, Condition, Fingerprinted, Result
+from ..util import create_temp_dir, expect_type, scan_files, chown
 from ..codes import WorkflowCode
-from .file_bundle import FileBundle
+from ..config import data_path
+from .file_bundle import BlobStore, FileBundle
 from .measure_command_execution import CompletedContainer, measure_docker_execution
 from .machine import Machine
 from .workflow_executors import executors, WorkflowExecutor
 from ..conditions import WorkflowCondition
 
 
-class ExecuteWorkflow(Analysis):
+class ExecuteWorkflow(Analysis, Fingerprinted):
     def analyze(
         self,
         code: Code,
@@ -31,22 +32,29 @@ class ExecuteWorkflow(Analysis):
             for dir in [log_dir, out_dir]:
                 dir.mkdir()
             executor = executors[code.executor]
+            before = {entry.path: entry for entry in scan_files(code_path)}
             procs = executor.do_commands(code_path, out_dir, log_dir, condition)
-            for src in walk_files(code_path):
-                if procs and src.is_file() and mtime(src) >= procs[0].start:
-                    dst = out_dir / src.relative_to(code_path)
+            after = {entry.path: entry for entry in scan_files(code_path)}
+            # Outputs are the files that were created or changed (according to ctime, so preserved mtimes don't hide them) since the first command.
+            # The executor itself may change files before that (e.g., to instrument scripts), and those aren't outputs.
+            for path, entry in after.items() if procs else []:
+                if entry.is_file and before.get(path) != entry and entry.ctime >= procs[0].start:
+                    dst = out_dir / path.relative_to(code_path)
                     dst.parent.mkdir(exist_ok=True, parents=True)
-                    shutil.move(src, dst)
-            outputs = FileBundle.from_path(out_dir)
-            logs = FileBundle.from_path(log_dir)
-            chown(tmp_path)
-            chown(code_path)
+                    shutil.move(path, dst)
+            deleted_files = tuple(sorted(path.relative_to(code_path) for path in before.keys() - after.keys()))
+            # Many outputs are the same across conditions and iterations (e.g., command.sh, flake.nix), so we dedup them in a BlobStore.
+            blob_store = BlobStore(data_path() / "blobs")
+            outputs = FileBundle.from_path(out_dir, blob_store=blob_store)
+            logs = FileBundle.from_path(log_dir, blob_store=blob_store)
+            chown(tmp_path, code_path)
         return WorkflowExecution(
             machine=Machine.current_machine(),
             outputs=outputs,
             logs=logs,
             condition=condition,
             procs=procs,
+            deleted_files=deleted_files,
         )
 
 
@@ -57,3 +65,4 @@ class WorkflowExecution(Result):
     logs: FileBundle
     condition: Condition
     procs: tuple[CompletedContainer, ...]
+    deleted_files: tuple[pathlib.Path, ...] = ()
@@ -1,11 +1,50 @@
 from __future__ import annotations
+import collections
+import concurrent.futures
+import contextlib
 import dataclasses
+import io
+import mmap
+import os
 import pathlib
 import shutil
 import subprocess
-from typing import Mapping, Iterable
+import tarfile
+import tempfile
+import threading
+from typing import IO, Mapping, Iterable, Optional, Sequence, cast
 
-from ..util import hash_path, mime_type, file_type, hash_path, create_temp_dir, walk_files, random_str
+import upath
+
+from ..config import data_path as config_data_path
+from ..util import hash_path, mime_type, file_type, file_types, hash_path, create_temp_dir, scan_files, random_str, atomic_write_bytes, shorten_lines_stream
+
+
+@dataclasses.dataclass(frozen=True)
+class BlobStore:
+    """Content-addressed storage for file contents, so identical files get stored once, no matter how many Files refer to them.
+
+    root can be local or a UPath.
+    A local root is made absolute, so the Files that refer to its blobs don't depend on the working directory.
+
+    """
+    root: pathlib.Path
+
+    def __post_init__(self) -> None:
+        if not isinstance(self.root, upath.UPath):
+            # object.__setattr__ works even on frozen dataclasses.
+            object.__setattr__(self, "root", self.root.resolve())
+
+    def put(self, hash_val: int, contents: bytes) -> pathlib.Path:
+        blob = self.root / f"{hash_val:016x}-{len(contents)}"
+        if not blob.exists():
+            if isinstance(blob, upath.UPath):
+                # Object stores write blobs atomically (and UPath cannot rename, anyway).
+                blob.write_bytes(contents)
+            else:
+                blob.parent.mkdir(parents=True, exist_ok=True)
+                atomic_write_bytes(blob, contents)
+        return blob
 
 
 @dataclasses.dataclass(frozen=True)
@@ -18,6 +57,8 @@ class File:
     mime_type: str
     url: pathlib.Path | None
     contents: bytes | None
+    # Where the contents are stored, if they are not stored inline (see BlobStore).
+    contents_ref: pathlib.Path | None = None
 
     @staticmethod
     def from_path(path: pathlib.Path, url: pathlib.Path | None = None) -> File:
@@ -35,12 +76,69 @@ class File:
             contents=path.read_bytes(),
         )
 
+    @staticmethod
+    def from_paths(
+            paths: Sequence[pathlib.Path],
+            urls: Sequence[pathlib.Path | None] | None = None,
+            parallelism: int = 16,
+            blob_store: BlobStore | None = None,
+    ) -> list[File]:
+        """Like `[File.from_path(path, url) for path, url in zip(paths, urls)]`, but faster for many files.
+
+        This classifies all of the files in one `file` process (per classification),
+        and reads each file only once (for both its hash and its contents), in a thread pool.
+
+        If blob_store is given, contents go there, rather than inline in the File,
+        and we only keep the contents of the files currently being read.
+
+        """
+        import xxhash
+        paths = [path.resolve() for path in paths]
+        if urls is None:
+            urls = [None] * len(paths)
+        elif len(urls) != len(paths):
+            raise ValueError(f"Got {len(urls)} urls for {len(paths)} paths")
+        for path in paths:
+            if not path.is_file():
+                raise ValueError(f"{path} is not a regular file")
+        def read(path: pathlib.Path) -> tuple[int, int, bytes | None, pathlib.Path | None]:
+            contents = path.read_bytes()
+            hash_val = xxhash.xxh64(contents).intdigest()
+            if blob_store is None:
+                return len(contents), hash_val, contents, None
+            else:
+                return len(contents), hash_val, None, blob_store.put(hash_val, contents)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallelism) as executor:
+            these_file_types = executor.submit(file_types, paths)
+            these_mime_types = executor.submit(file_types, paths, mime=True)
+            reads = list(executor.map(read, paths))
+        return [
+            File(
+                hash_algo="xxhash",
+                hash_bits=64,
+                hash_val=hash_val,
+                size=size,
+                file_type=this_file_type,
+                mime_type=this_mime_type,
+                url=path if url is None else url,
+                contents=contents,
+                contents_ref=contents_ref,
+            )
+            for path, url, (size, hash_val, contents, contents_ref), this_file_type, this_mime_type in zip(
+                    paths,
+                    urls,
+                    reads,
+                    these_file_types.result(),
+                    these_mime_types.result(),
+            )
+        ]
+
     @staticmethod
     def blank() -> File:
         return File(
             hash_algo="xxhash",
             hash_bits=64,
-            hash_val=hash_path(pathlib.Path("/dev/null", size=64)),
+            hash_val=hash_path(pathlib.Path("/dev/null"), size=64),
             size=0,
             file_type="empty",
             mime_type="inode/x-empty",
@@ -58,6 +156,7 @@ class File:
             mime_type=self.mime_type,
             url=self.url,
             contents=None,
+            contents_ref=self.contents_ref,
         )
 
     def __eq__(self, other: object) -> bool:
@@ -82,69 +181,311 @@ class File:
         return self.size == 0
 
     def read_bytes(self) -> bytes | None:
-        """Return the bytes of this file, if we have them, else None."""
+        """Return the bytes of this file, if we stored them (inline or in a BlobStore), else raise."""
         if self.contents is not None:
             return self.contents
+        elif self.contents_ref is not None:
+            return self.contents_ref.read_bytes()
         else:
             raise RuntimeError("We didn't store the bytes of this file.")
 
+    def open(self) -> IO[bytes]:
+        """Open the bytes of this file, without reading them all into memory (unless they are already inline).
+
+        Contents in a local BlobStore are memory-mapped; contents in a remote one are streamed.
+
+        """
+        if self.contents is not None:
+            return io.BytesIO(self.contents)
+        elif self.contents_ref is not None:
+            if isinstance(self.contents_ref, upath.UPath) or self.size == 0:
+                return cast(IO[bytes], self.contents_ref.open("rb"))
+            else:
+                with self.contents_ref.open("rb") as fileobj:
+                    return cast(IO[bytes], mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ))
+        else:
+            raise RuntimeError("We didn't store the bytes of this file.")
+
+    def shorten_lines(self, n_front_lines: int, n_back_lines: int) -> str:
+        """The first and last few lines of this file, decoded; see util.shorten_lines."""
+        with self.open() as fileobj:
+            return shorten_lines_stream(fileobj, n_front_lines, n_back_lines)
+
+
+@dataclasses.dataclass(frozen=True)
+class ArchiveMember:
+    """Where a file is in a FileBundle's archive.
+
+    The archive is a sequence of zstd frames, each of which decompresses to a piece of a tar stream.
+    The file's data is at data_offset in the frame at frame_offset.
+
+    """
+    frame_offset: int
+    frame_size: int
+    data_offset: int
+    size: int
+
+
+class _CountingWriter:
+    """Gives tarfile a tell(), which pipes lack."""
+    def __init__(self, fileobj: IO[bytes]) -> None:
+        self.fileobj = fileobj
+        self.offset = 0
+
+    def write(self, data: bytes) -> int:
+        self.fileobj.write(data)
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.offset
+
+
+class _HashingReader:
+    def __init__(self, fileobj: IO[bytes]) -> None:
+        import xxhash
+        self.fileobj = fileobj
+        self.hasher = xxhash.xxh64()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fileobj.read(size)
+        self.hasher.update(data)
+        return data
+
+
+_chunk_size = 1024**2
+
+
+def _tar_zstd_frame(data_path: pathlib.Path, paths: Sequence[pathlib.Path], level: int) -> tuple[IO[bytes], list[int], list[int], list[int]]:
+    """Tar paths (relative to data_path) into one zstd frame, without the end-of-archive marker.
+
+    Returns the frame (in an anonymous temporary file, since one large path makes a large frame),
+    and the data offset (in the decompressed frame), size, and hash of each path.
+
+    """
+    frame = tempfile.TemporaryFile()
+    proc = subprocess.Popen(["zstd", "--quiet", "--stdout", f"-{level}"], stdin=subprocess.PIPE, stdout=frame)
+    assert proc.stdin is not None
+    data_offsets: list[int] = []
+    sizes: list[int] = []
+    hash_vals: list[int] = []
+    try:
+        # We never close the TarFile, because that would write the end-of-archive marker.
+        tar = tarfile.open(fileobj=_CountingWriter(proc.stdin), mode="w", format=tarfile.PAX_FORMAT)  # type: ignore
+        for path in paths:
+            tarinfo = tar.gettarinfo(str(data_path / path), arcname=str(path))
+            with (data_path / path).open("rb") as fileobj:
+                reader_with_hash = _HashingReader(fileobj)
+                tar.addfile(tarinfo, reader_with_hash)  # type: ignore
+            padded_size = -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            data_offsets.append(tar.offset - padded_size)
+            sizes.append(tarinfo.size)
+            hash_vals.append(reader_with_hash.hasher.intdigest())
+    finally:
+        proc.stdin.close()
+        if proc.wait() != 0:
+            frame.close()
+            raise RuntimeError(f"zstd exited with {proc.returncode}")
+    frame.seek(0)
+    return frame, data_offsets, sizes, hash_vals
+
 
 @dataclasses.dataclass(frozen=True)
 class FileBundle:
     archive: File | None
     files: Mapping[pathlib.Path, File]
+    archive_members: Optional[Mapping[pathlib.Path, ArchiveMember]] = None
 
     @staticmethod
-    def from_path(data_path: pathlib.Path, compress: bool = False, move: bool = False) -> FileBundle:
-        # TODO: make this be a true remote archive.
-        contents: dict[pathlib.Path, File] = {}
-        for path in walk_files(data_path, full_path=False):
-            if (data_path / path).is_file() and not (data_path / path).is_symlink():
-                contents[path] = File.from_path(data_path / path)
+    def from_path(data_path: pathlib.Path, compress: bool = False, move: bool = False, blob_store: BlobStore | None = None) -> FileBundle:
+        paths = sorted(
+            entry.path
+            for entry in scan_files(data_path, full_path=False)
+            if entry.is_file and not entry.is_symlink
+        )
         if compress:
             assert move
             # This branch puts all of the files from data_path into an archive in a remote destination
-            remote_archive = pathlib.Path(".cache2") / (random_str(10) + ".tar.xz")
-            with create_temp_dir() as temp_dir:
-                local_archive = temp_dir / remote_archive.name
-                (temp_dir / "files").write_text(
-                    "\n".join(
-                        str(member.relative_to(data_path))
-                        for member in data_path.iterdir()
-                    ) + "\n"
-                )
-                cmd = ["tar", "--create", "--xz", f"--file={local_archive}", f"--files-from={temp_dir / 'files'}"]
-                proc = subprocess.run(
-                    cmd,
-                    cwd=data_path,
-                    check=True,
-                    capture_output=True,
-                    text=True,
-                )
-                with local_archive.open("rb") as src_fileobj, remote_archive.open("wb") as dst_fileobj:
-                    shutil.copyfileobj(src_fileobj, dst_fileobj)
-                return FileBundle(File.from_path(local_archive, remote_archive), contents)
-        elif move:
-            # This branch puts all of the files from in a remote destination
-            remote_archive = pathlib.Path(".cache2") / random_str(10)
-            remote_archive.mkdir(parents=True)
+            return FileBundle._to_archive(data_path, paths)
+        # The files will be at remote_dir if we move them.
+        remote_dir = config_data_path() / "moved" / random_str(10)
+        if not isinstance(remote_dir, upath.UPath):
+            remote_dir = remote_dir.resolve()
+        contents: dict[pathlib.Path, File] = dict(zip(paths, File.from_paths(
+            [data_path / path for path in paths],
+            urls=[remote_dir / path for path in paths] if move else None,
+            blob_store=blob_store,
+        )))
+        if move:
+            # This branch puts all of the files in a remote destination
             for path in contents.keys():
-                (remote_archive / path).parent.mkdir(parents=True, exist_ok=True)
-                shutil.move(data_path / path, remote_archive / path)
-            index_file = remote_archive / "index"
-            index_file.write_text("\n".join(map(str, contents.keys())))
-            return FileBundle(File.from_path(index_file), contents)
+                if isinstance(remote_dir, upath.UPath):
+                    # UPath cannot rename, and object stores have no directories to make.
+                    (remote_dir / path).write_bytes((data_path / path).read_bytes())
+                    (data_path / path).unlink()
+                else:
+                    (remote_dir / path).parent.mkdir(parents=True, exist_ok=True)
+                    shutil.move(data_path / path, remote_dir / path)
+            index = "\n".join(map(str, contents.keys()))
+            index_file = remote_dir / "index"
+            if isinstance(index_file, upath.UPath):
+                index_file.write_text(index)
+                # File.from_path needs a local file to classify.
+                with create_temp_dir() as temp_dir:
+                    (temp_dir / "index").write_text(index)
+                    return FileBundle(File.from_path(temp_dir / "index", url=index_file), contents)
+            else:
+                index_file.parent.mkdir(parents=True, exist_ok=True)
+                index_file.write_text(index)
+                return FileBundle(File.from_path(index_file), contents)
         else:
             # This branch puts all of the files into this object in RAM
             return FileBundle(None, contents)
 
+    @staticmethod
+    def _to_archive(
+            data_path: pathlib.Path,
+            paths: Sequence[pathlib.Path],
+            frame_size: int = 32 * 1024**2,
+            parallelism: int = os.cpu_count() or 1,
+            level: int = 3,
+    ) -> FileBundle:
+        """Stream paths into a .tar.zst in config.data_path(), without keeping their contents.
+
+        Files are grouped into frames of about frame_size (uncompressed) bytes, which get compressed in parallel.
+        Concatenated zstd frames are still one zstd stream, so `tar --zstd --extract` works on the whole archive,
+        but read_member only has to decompress the frame containing its member.
+
+        """
+        import xxhash
+        frames: list[list[pathlib.Path]] = [[]]
+        current_frame_size = 0
+        for path in paths:
+            if current_frame_size >= frame_size:
+                frames.append([])
+                current_frame_size = 0
+            frames[-1].append(path)
+            current_frame_size += (data_path / path).stat().st_size
+
+        remote_archive = config_data_path() / "archives" / f"{random_str(10)}.tar.zst"
+        remote_archive.parent.mkdir(parents=True, exist_ok=True)
+        hasher = xxhash.xxh64()
+        archive_size = 0
+        archive_members: dict[pathlib.Path, ArchiveMember] = {}
+        files: dict[pathlib.Path, tuple[int, int]] = {}
+        full_paths = [data_path / path for path in paths]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallelism) as executor, remote_archive.open("wb") as archive_fileobj:
+            these_file_types = executor.submit(file_types, full_paths)
+            these_mime_types = executor.submit(file_types, full_paths, mime=True)
+            # Keep a bounded window of frames in flight, so we don't hold every compressed frame in memory.
+            pending: collections.deque[tuple[list[pathlib.Path], concurrent.futures.Future[tuple[IO[bytes], list[int], list[int], list[int]]]]] = collections.deque()
+            for frame_paths in [*frames, None]:
+                if frame_paths is not None:
+                    pending.append((frame_paths, executor.submit(_tar_zstd_frame, data_path, frame_paths, level)))
+                while pending and (frame_paths is None or len(pending) > 2 * parallelism):
+                    done_paths, future = pending.popleft()
+                    frame, data_offsets, sizes, hash_vals = future.result()
+                    compressed_size = 0
+                    with frame:
+                        while chunk := frame.read(_chunk_size):
+                            archive_fileobj.write(chunk)
+                            hasher.update(chunk)
+                            compressed_size += len(chunk)
+                    for path, data_offset, size, hash_val in zip(done_paths, data_offsets, sizes, hash_vals):
+                        archive_members[path] = ArchiveMember(archive_size, compressed_size, data_offset, size)
+                        files[path] = (size, hash_val)
+                    archive_size += compressed_size
+            end_of_archive = subprocess.run(
+                ["zstd", "--quiet", "--stdout"],
+                input=bytes(2 * tarfile.BLOCKSIZE),
+                capture_output=True,
+                check=True,
+            ).stdout
+            archive_fileobj.write(end_of_archive)
+            hasher.update(end_of_archive)
+            archive_size += len(end_of_archive)
+        return FileBundle(
+            File(
+                hash_algo="xxhash",
+                hash_bits=64,
+                hash_val=hasher.intdigest(),
+                size=archive_size,
+                file_type="Zstandard compressed data",
+                mime_type="application/zstd",
+                url=remote_archive,
+                contents=None,
+            ),
+            {
+                path: File(
+                    hash_algo="xxhash",
+                    hash_bits=64,
+                    hash_val=files[path][1],
+                    size=files[path][0],
+                    file_type=this_file_type,
+                    mime_type=this_mime_type,
+                    url=full_path.resolve(),
+                    contents=None,
+                )
+                for path, full_path, this_file_type, this_mime_type in zip(
+                        paths,
+                        full_paths,
+                        these_file_types.result(),
+                        these_mime_types.result(),
+                )
+            },
+            archive_members,
+        )
+
+    def read_member(self, path: pathlib.Path) -> bytes:
+        """Read one file out of this bundle's archive, decompressing only the frame which contains it.
+
+        The frame is streamed through zstd, which stops as soon as we have the file,
+        so neither the frame nor the rest of its decompressed contents are held in memory.
+
+        """
+        if self.archive is None or self.archive.url is None or self.archive_members is None:
+            raise ValueError("This FileBundle has no archive")
+        archive_url = self.archive.url
+        member = self.archive_members[path]
+        proc = subprocess.Popen(["zstd", "--decompress", "--quiet", "--stdout"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        assert proc.stdin is not None and proc.stdout is not None
+        stdin = proc.stdin
+        def feed() -> None:
+            # zstd's stdin breaks if we stop reading its stdout early, which is fine.
+            with contextlib.suppress(BrokenPipeError):
+                try:
+                    with archive_url.open("rb") as archive_fileobj:
+                        archive_fileobj.seek(member.frame_offset)
+                        remaining = member.frame_size
+                        while remaining > 0 and (chunk := archive_fileobj.read(min(remaining, _chunk_size))):
+                            stdin.write(chunk)
+                            remaining -= len(chunk)
+                finally:
+                    stdin.close()
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        try:
+            remaining = member.data_offset
+            while remaining > 0 and (chunk := proc.stdout.read(min(remaining, _chunk_size))):
+                remaining -= len(chunk)
+            data = proc.stdout.read(member.size)
+        finally:
+            proc.kill()
+            proc.stdout.close()
+            proc.wait()
+            feeder.join()
+        if len(data) != member.size:
+            raise RuntimeError(f"{archive_url} ended before {path}")
+        return data
+
     def truncate(self, size: int) -> FileBundle:
         return FileBundle(
-            None,
+            self.archive,
             {
                 path: file.truncate() if file.size > size else file
                 for path, file in self.files.items()
-            }
+            },
+            self.archive_members,
         )
 
     @staticmethod
@@ -5,7 +5,7 @@ from typing import Optional
 
 import git
 
-from charmonium.test_py.types import Analysis, Code, Condition, Result
+from charmonium.test_py.types import Analysis, Code, Condition, Fingerprinted, Result
 
 
 @dataclasses.dataclass
@@ -19,7 +19,7 @@ class GitInfoResult(Result):
     committer: Optional[str]
     co_authors: list[str]
 
-class GitInfo(Analysis):
+class GitInfo(Analysis, Fingerprinted):
     def analyze(
             self,
             code: Code,
@@ -1,19 +1,30 @@
+from __future__ import annotations
+import asyncio
+import contextlib
 import dataclasses
 import datetime
 import os
 import pathlib
 import shlex
+import shutil
+import signal
+import ssl
 import subprocess
 import time
 import warnings
 import textwrap
-from typing import Iterable, Mapping
+import threading
+from typing import IO, Any, AsyncGenerator, ContextManager, Generator, Iterable, Mapping, TypeVar
 
+import aiohttp
+import docker  # type: ignore
 import psutil
 import requests
+import xxhash
 
-from ..util import create_temp_dir
+from ..util import create_temp_dir, expect_type, random_str
 from ..config import docker_client
+from .cgroup_sampler import CgroupSampler, ResourceSample
 
 
 @dataclasses.dataclass(frozen=True)
@@ -26,6 +37,7 @@ class ComputeResource:
     io_bytes_read: int | None = None
     io_bytes_written: int | None = None
     scheduler_context_switches: int | None = None
+    time_series: tuple[ResourceSample, ...] | None = None
 
 
 @dataclasses.dataclass(frozen=True)
@@ -38,6 +50,10 @@ class CompletedProcess:
     start: datetime.datetime
     stdout_b: bytes
     stderr_b: bytes
+    stdout_size: int | None = None
+    stderr_size: int | None = None
+    stdout_hash: int | None = None
+    stderr_hash: int | None = None
 
     @property
     def stdout(self) -> str:
@@ -81,49 +97,174 @@ Stderr:
 """
 
 
+def _drain(stream: IO[bytes], sink: IO[bytes] | None, buffer: HeadTailBuffer) -> None:
+    """Read stream until EOF into buffer, and, if given, the first buffer.max_size bytes into sink."""
+    kept = 0
+    while chunk := stream.read1(1 << 16):  # type: ignore
+        if sink is not None:
+            if buffer.max_size is None or kept < buffer.max_size:
+                sink_chunk = chunk if buffer.max_size is None else chunk[:buffer.max_size - kept]
+                sink.write(sink_chunk)
+                kept += len(sink_chunk)
+            buffer.size += len(chunk)
+        else:
+            buffer.write(chunk)
+    stream.close()
+
+
+def _read_peak_rss(pid: int) -> int | None:
+    """Peak RSS of pid since it last exec'ed (VmHWM), or None if it has exited."""
+    try:
+        status = pathlib.Path(f"/proc/{pid}/status").read_text()
+    except OSError:
+        return None
+    for line in status.split("\n"):
+        if line.startswith("VmHWM:"):
+            return int(line.split()[1]) * 1024
+    return None
+
+
 def measure_command_execution(
         command: tuple[str, ...],
         env_override: Mapping[str, str] | None = None,
         clear_env: bool = False,
         cwd: pathlib.Path = pathlib.Path(),
+        wall_time_limit: datetime.timedelta | None = None,
+        kill_after: datetime.timedelta = datetime.timedelta(seconds=120),
+        stdout_path: pathlib.Path | None = None,
+        stderr_path: pathlib.Path | None = None,
+        max_output_size: int | None = None,
+        sample_interval: datetime.timedelta = datetime.timedelta(seconds=0.05),
 ) -> CompletedProcess:
+    """Run command locally and measure its resource usage.
+
+    Both output streams get drained while the command runs, into stdout_b and stderr_b,
+    or into stdout_path and stderr_path, if those are given (leaving stdout_b or stderr_b empty).
+    At most max_output_size bytes of each stream are kept;
+    the first and last halves of it in stdout_b and stderr_b (see HeadTailBuffer), or the beginning of it in the files.
+
+    Like timeout(1), the command's process group gets SIGTERM after wall_time_limit (exit code 124),
+    and SIGKILL if it is still running kill_after that (exit code 128+9).
+    The limit also covers descendants that outlive the command while holding its output streams open.
+
+    CPU time and context switches come from wait4, so they include the descendants which the command waited on.
+    Peak RSS is the largest VmHWM of the command and its descendants, sampled every sample_interval.
+    (wait4's ru_maxrss would include the memory of this process, which the command had before it exec'ed.)
+    Memory used by a process after its last sample is missed, so a command that exits before the first sample reports 0.
+
+    """
     env = {} if clear_env else dict(os.environ)
     if env_override is not None:
         env.update(env_override)
     cwd = cwd.resolve()
-    start = datetime.datetime.now()
-    process = psutil.Popen(
-        command,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        env=env,
-        cwd=cwd,
-    )
-    exit_code = process.wait()
-    with process.oneshot():
-        wall_time = datetime.datetime.now() - start
-        cpu_times = process.cpu_times()
-        io_counters = process.io_counters()  # type: ignore
-        memory_info = process.memory_info()
-        resource = ComputeResource(
-            user_cpu_time=datetime.timedelta(seconds=cpu_times.user),
-            system_cpu_time=datetime.timedelta(seconds=cpu_times.system),
-            max_resident_set_size=memory_info.rss,
-            max_virtual_memory_size=memory_info.vms,
-            wall_time=wall_time,
-            io_bytes_read=io_counters.read_bytes,
-            io_bytes_written=io_counters.write_bytes,
-            scheduler_context_switches=process.ctx_switches()
+    with contextlib.ExitStack() as exit_stack:
+        sinks = [
+            exit_stack.enter_context(path.open("wb")) if path is not None else None
+            for path in [stdout_path, stderr_path]
+        ]
+        start = datetime.datetime.now()
+        process = subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+            cwd=cwd,
+            # So we can signal the command's descendants too.
+            start_new_session=True,
         )
+        stdout_buffer = HeadTailBuffer(max_output_size)
+        stderr_buffer = HeadTailBuffer(max_output_size)
+        drainers = [
+            threading.Thread(target=_drain, args=(stream, sink, buffer), daemon=True)
+            for stream, sink, buffer in zip([process.stdout, process.stderr], sinks, [stdout_buffer, stderr_buffer])
+        ]
+        for drainer in drainers:
+            drainer.start()
+
+        # The watchdog only signals the process group while holding signal_lock and before done is set,
+        # and we only set done before reaping the process (whose PID is the PGID), so it can never signal a recycled PGID.
+        signal_lock = threading.Lock()
+        done = threading.Event()
+        terminated = threading.Event()
+        killed = threading.Event()
+        def watchdog(wall_time_limit: datetime.timedelta) -> None:
+            for limit, signal_sent, signum in [
+                    (wall_time_limit, terminated, signal.SIGTERM),
+                    (kill_after, killed, signal.SIGKILL),
+            ]:
+                if done.wait(limit.total_seconds()):
+                    return
+                with signal_lock:
+                    if done.is_set():
+                        return
+                    signal_sent.set()
+                    with contextlib.suppress(ProcessLookupError):
+                        os.killpg(process.pid, signum)
+        if wall_time_limit is not None:
+            threading.Thread(target=watchdog, args=(wall_time_limit,), daemon=True).start()
+
+        peak_rss = 0
+        def sample_peak_rss() -> None:
+            nonlocal peak_rss
+            try:
+                pids = [process.pid, *(child.pid for child in psutil.Process(process.pid).children(recursive=True))]
+            except psutil.Error:
+                pids = [process.pid]
+            for pid in pids:
+                peak_rss = max(peak_rss, _read_peak_rss(pid) or 0)
+        def sample_until_exited() -> None:
+            while True:
+                sample_peak_rss()
+                if exited.wait(sample_interval.total_seconds()):
+                    return
+        exited = threading.Event()
+        sampler = threading.Thread(target=sample_until_exited, daemon=True)
+        sampler.start()
+
+        # Wait for the process to exit, but leave it unreaped, so we can still read its I/O counters.
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        wall_time = datetime.datetime.now() - start
+        exited.set()
+        sampler.join()
+        with signal_lock:
+            # Whether the command itself exited because of the watchdog, rather than just its descendants.
+            exit_code_override = 128 + 9 if killed.is_set() else 124 if terminated.is_set() else None
+        try:
+            io_counters = psutil.Process(process.pid).io_counters()  # type: ignore
+        except psutil.Error:
+            io_counters = None
+        # Descendants may hold the streams open after the command exits, so we drain them before disarming the watchdog.
+        for drainer in drainers:
+            drainer.join()
+        with signal_lock:
+            done.set()
+        _, status, rusage = os.wait4(process.pid, 0)
+        # Let Popen know that we already reaped it.
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+    resource = ComputeResource(
+        user_cpu_time=datetime.timedelta(seconds=rusage.ru_utime),
+        system_cpu_time=datetime.timedelta(seconds=rusage.ru_stime),
+        max_resident_set_size=peak_rss,
+        wall_time=wall_time,
+        io_bytes_read=io_counters.read_bytes if io_counters is not None else rusage.ru_inblock * 512,
+        io_bytes_written=io_counters.write_bytes if io_counters is not None else rusage.ru_oublock * 512,
+        scheduler_context_switches=rusage.ru_nvcsw + rusage.ru_nivcsw,
+    )
     return CompletedProcess(
         command=command,
         env=env,
         cwd=cwd,
         resource=resource,
-        exit_code=exit_code,
+        exit_code=exit_code_override if exit_code_override is not None else process.returncode,
         start=start,
-        stdout_b=process.stdout,
-        stderr_b=process.stderr,
+        stdout_b=stdout_buffer.getvalue(),
+        stderr_b=stderr_buffer.getvalue(),
+        stdout_size=stdout_buffer.size,
+        stderr_size=stderr_buffer.size,
+        # When streaming to a file, the file has the contents, so we don't bother hashing.
+        stdout_hash=stdout_buffer.hash() if stdout_path is None else None,
+        stderr_hash=stderr_buffer.hash() if stderr_path is None else None,
     )
 
 
@@ -137,127 +278,627 @@ class CompletedContainer:
     start: datetime.datetime
     stdout_b: bytes
     stderr_b: bytes
+    stdout_size: int | None = None
+    stderr_size: int | None = None
+    stdout_hash: int | None = None
+    stderr_hash: int | None = None
 
 
-def measure_docker_execution(
-        image: str,
+def _utf8_sequence_length(lead_byte: int) -> int:
+    if lead_byte < 0b1100_0000:
+        return 1
+    elif lead_byte < 0b1110_0000:
+        return 2
+    elif lead_byte < 0b1111_0000:
+        return 3
+    else:
+        return 4
+
+
+def _utf8_prefix(data: bytearray) -> bytearray:
+    """data without a UTF-8 character that is cut off at its end."""
+    # A character is at most 4 bytes, so only the last 3 bytes can start an incomplete one.
+    for start in range(len(data) - 1, max(-1, len(data) - 4), -1):
+        if data[start] & 0b1100_0000 != 0b1000_0000:
+            return data[:start] if start + _utf8_sequence_length(data[start]) > len(data) else data
+    return data
+
+
+def _utf8_suffix(data: bytearray) -> bytearray:
+    """data without the continuation bytes at its start, which belong to a character that is cut off."""
+    start = 0
+    while start < min(3, len(data)) and data[start] & 0b1100_0000 == 0b1000_0000:
+        start += 1
+    return data[start:]
+
+
+class HeadTailBuffer:
+    """Keeps the first and last max_size // 2 bytes written to it, and the size and hash of everything written to it.
+
+    If max_size is None, everything is kept.
+    Otherwise, the cuts are moved to UTF-8 character boundaries, so the kept bytes of UTF-8 output still decode.
+
+    """
+
+    def __init__(self, max_size: int | None) -> None:
+        self.max_size = max_size
+        self.size = 0
+        self._head = bytearray()
+        self._tail = bytearray()
+        self._hasher = xxhash.xxh128()
+
+    def write(self, chunk: bytes) -> None:
+        self.size += len(chunk)
+        self._hasher.update(chunk)
+        if self.max_size is None:
+            self._head += chunk
+        else:
+            head_room = self.max_size // 2 - len(self._head)
+            if head_room > 0:
+                self._head += chunk[:head_room]
+                chunk = chunk[head_room:]
+            self._tail += chunk
+            # Deleting from the front of a bytearray does not copy the rest.
+            del self._tail[:max(0, len(self._tail) - (self.max_size - self.max_size // 2))]
+
+    def write_file(self, path: pathlib.Path, block_size: int = 1 << 20) -> None:
+        with path.open("rb") as file:
+            while block := file.read(block_size):
+                self.write(block)
+
+    def getvalue(self) -> bytes:
+        omitted = self.size - len(self._head) - len(self._tail)
+        if omitted:
+            head = _utf8_prefix(self._head)
+            tail = _utf8_suffix(self._tail)
+            omitted = self.size - len(head) - len(tail)
+            return bytes(head + f"\n[... {omitted} bytes omitted ...]\n".encode() + tail)
+        else:
+            return bytes(self._head + self._tail)
+
+    def hash(self) -> int:
+        return expect_type(int, self._hasher.intdigest())
+
+
+class ContainerPool:
+    """Long-lived containers in which measure_docker_execution can run commands with `docker exec`, rather than starting a fresh container each time.
+
+    Each container runs one command at a time, so each command still gets the container's memory and CPU limits to itself.
+    However, commands share the container's filesystem outside of the mounts (e.g., R packages installed to ~/.R/lib),
+    so a pool should only be shared by commands that may see each other's side-effects, like the scripts of one workflow.
+
+    Each container binds the same directories that a fresh container for the command would,
+    except that the command's temp dir (see temp_dir()) is under the pool's own scratch_dir, which the containers bind instead;
+    commands with different binds get different containers.
+
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._idle: dict[tuple[str, int, float, bool, tuple[tuple[str, str, str], ...]], list[Any]] = {}
+        self._containers: list[Any] = []
+        self._entrypoints: dict[str, tuple[str, ...]] = {}
+        self._exit_stack = contextlib.ExitStack()
+        self.scratch_dir = self._exit_stack.enter_context(create_temp_dir())
+
+    def __enter__(self) -> ContainerPool:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    @contextlib.contextmanager
+    def temp_dir(self) -> Generator[pathlib.Path, None, None]:
+        """A fresh directory for one command's outputs, which the pool's containers can see."""
+        temp_dir = self.scratch_dir / random_str(10)
+        temp_dir.mkdir()
+        try:
+            yield temp_dir
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def exec_run(
+            self,
+            image: str,
+            command: tuple[str, ...],
+            *,
+            volumes: Mapping[str, Mapping[str, str]],
+            mem_limit: int,
+            cpus: float,
+            privileged: bool,
+            sampler: CgroupSampler | None = None,
+    ) -> tuple[int, str]:
+        """Run command as if it were passed to `docker run --volume ... image`, but in one of the pool's containers.
+
+        volumes should come from `_docker_volumes(self.scratch_dir, ...)`.
+        Returns the command's exit code and the equivalent `docker run` command,
+        since the container that actually ran it may be gone by the time anyone re-runs it.
+
+        """
+        with self._container(image, mem_limit, cpus, privileged, volumes) as container:
+            with sampler.watch(container.id, whole_container=False) if sampler is not None else contextlib.nullcontext():
+                result = container.exec_run([*self._entrypoints[image], *command], privileged=privileged)
+        docker_command = _docker_run_command(image, command, volumes, privileged=privileged, mem_limit=mem_limit, cpus=cpus)
+        return expect_type(int, result.exit_code), docker_command
+
+    @contextlib.contextmanager
+    def _container(
+            self,
+            image: str,
+            mem_limit: int,
+            cpus: float,
+            privileged: bool,
+            volumes: Mapping[str, Mapping[str, str]],
+    ) -> Generator[Any, None, None]:
+        key = (image, mem_limit, cpus, privileged, tuple(sorted(
+            (host_dir, options["bind"], options["mode"])
+            for host_dir, options in volumes.items()
+        )))
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            container = idle.pop() if idle else None
+        if container is None:
+            if image not in self._entrypoints:
+                self._entrypoints[image] = tuple(docker_client().images.get(image).attrs["Config"].get("Entrypoint") or ())
+            container = docker_client().containers.run(
+                image,
+                ("exec sleep infinity",),
+                entrypoint=("/bin/sh", "-c"),
+                privileged=privileged,
+                mem_limit=mem_limit,
+                auto_remove=False,
+                detach=True,
+                nano_cpus=int(cpus * 1e9),
+                volumes=volumes,
+            )
+            with self._lock:
+                self._containers.append(container)
+        healthy = False
+        try:
+            yield container
+            container.reload()
+            # E.g., the OOM killer could have taken out the container's init process.
+            healthy = container.status == "running"
+        finally:
+            with self._lock:
+                if healthy:
+                    idle.append(container)
+                else:
+                    self._containers.remove(container)
+            if not healthy:
+                container.remove(force=True)
+
+    def close(self) -> None:
+        with self._lock:
+            containers = self._containers
+            self._containers = []
+            self._idle = {}
+        for container in containers:
+            container.remove(force=True)
+        self._exit_stack.close()
+
+
+def _docker_real_command(
         command: tuple[str, ...],
-        *,
+        temp_dir: pathlib.Path,
         wall_time_limit: datetime.timedelta,
+        kill_after: datetime.timedelta,
+        hold: bool = False,
+) -> tuple[str, ...]:
+    """The command to run in the container (whose entrypoint should be a shell) to measure command with `time`.
+
+    If hold, after command finishes, the container touches temp_dir/finished and waits for temp_dir/release before exiting (with command's exit code),
+    so that the container's cgroup can still be read (see _wait_held).
+
+    """
+    hold_suffix = (
+        f"; status=$?; touch {shlex.quote(str(temp_dir / 'finished'))}"
+        f"; while [ ! -e {shlex.quote(str(temp_dir / 'release'))} ]; do sleep 0.05; done"
+        "; exit $status"
+    ) if hold else ""
+    return (
+        # shlex.join would mess up the \ and > symbols.
+        " ".join([
+            # We use the \ to make sure we don't invoke the bash time internal
+            r"\time",
+            f"--output={shlex.quote(str(temp_dir / 'resources.txt'))}",
+            "--format='%M %S %U %e %x'",
+            "timeout",
+            "-k",
+            f"{kill_after.total_seconds():.0f}",
+            f"{wall_time_limit.total_seconds():.0f}",
+            *map(shlex.quote, command),
+            f">{shlex.quote(str(temp_dir / 'stdout'))}",
+            f"2>{shlex.quote(str(temp_dir / 'stderr'))}",
+        ]) + hold_suffix,
+    )
+
+
+def _hold_deadline(start: datetime.datetime, wall_time_limit: datetime.timedelta, kill_after: datetime.timedelta) -> datetime.datetime:
+    """When a held container should have finished its command, since `timeout` kills the command by wall_time_limit + kill_after."""
+    return start + wall_time_limit + kill_after + datetime.timedelta(seconds=30)
+
+
+def _wait_held(
+        container: Any,
+        temp_dir: pathlib.Path,
+        deadline: datetime.datetime,
+        poll: datetime.timedelta = datetime.timedelta(seconds=0.1),
+) -> None:
+    """Wait until the command of a container started with `_docker_real_command(..., hold=True)` finishes, or the container exits.
+
+    Raises TimeoutError if neither happens by deadline.
+    Errors talking to the Docker daemon (e.g., requests.exceptions.ConnectionError if it died) propagate.
+
+    """
+    while not (temp_dir / "finished").exists():
+        if datetime.datetime.now() > deadline:
+            raise TimeoutError(f"Container {container.id} neither finished its command nor exited by {deadline}")
+        try:
+            container.wait(timeout=poll.total_seconds())
+        except requests.exceptions.ReadTimeout:
+            continue
+        else:
+            return
+
+
+def _docker_volumes(
+        temp_dir: pathlib.Path,
+        readonly_mounts: Iterable[tuple[pathlib.Path, pathlib.Path]],
+        readwrite_mounts: Iterable[tuple[pathlib.Path, pathlib.Path]],
+        readonly_binds: Iterable[pathlib.Path],
+        readwrite_binds: Iterable[pathlib.Path],
+) -> dict[str, dict[str, str]]:
+    return {
+        str(temp_dir): {"bind": str(temp_dir), "mode": "rw"},
+        **{
+            str(mount): {"bind": str(mount), "mode": "ro"}
+            for mount in readonly_binds
+        },
+        **{
+            str(host_dir): {"bind": str(container_dir), "mode": "ro"}
+            for host_dir, container_dir in readonly_mounts
+        },
+        **{
+            str(mount): {"bind": str(mount), "mode": "rw"}
+            for mount in readwrite_binds
+        },
+        **{
+            str(host_dir): {"bind": str(container_dir), "mode": "rw"}
+            for host_dir, container_dir in readwrite_mounts
+        },
+    }
+
+
+def _docker_run_command(
+        image: str,
+        real_command: tuple[str, ...],
+        volumes: Mapping[str, Mapping[str, str]],
+        *,
+        privileged: bool,
         mem_limit: int,
         cpus: float,
-        privileged: bool = False,
-        readonly_mounts: Iterable[tuple[pathlib.Path, pathlib.Path]] = (),
-        readwrite_mounts: Iterable[tuple[pathlib.Path, pathlib.Path]] = (),
-        readonly_binds: Iterable[pathlib.Path] = (),
-        readwrite_binds: Iterable[pathlib.Path] = (),
-        kill_after: datetime.timedelta = datetime.timedelta(seconds=120),
+) -> str:
+    return shlex.join([
+        "docker",
+        "run",
+        f"--privileged={privileged!s}",
+        f"--memory={mem_limit}b",
+        f"--cpus={cpus:0.2f}",
+        *[
+            f"--volume={host_dir}:{options['bind']}:{options['mode']}"
+            for host_dir, options in volumes.items()
+        ],
+        image,
+        *real_command,
+    ])
+
+
+def _completed_container(
+        image: str,
+        command: tuple[str, ...],
+        docker_command: str,
+        temp_dir: pathlib.Path,
+        *,
+        start: datetime.datetime,
+        sampler: CgroupSampler | None,
+        time_series_length: int,
+        max_output_size: int | None,
+        container_exit_code: int | None = None,
+        oom_killed: bool = False,
 ) -> CompletedContainer:
-    with create_temp_dir() as temp_dir:
-        resource_file = temp_dir / "resources.txt"
-        stdout_file = temp_dir / "stdout"
-        stderr_file = temp_dir / "stderr"
-        # stdout_file.touch()
-        # stderr_file.touch()
-        real_command = (
-            # shlex.join would mess up the \ and > symbols.
-            " ".join([
-                # We use the \ to make sure we don't invoke the bash time internal
-                r"\time",
-                f"--output={shlex.quote(str(resource_file))}",
-                "--format='%M %S %U %e %x'",
-                "timeout",
-                "-k",
-                f"{kill_after.total_seconds():.0f}",
-                f"{wall_time_limit.total_seconds():.0f}",
-                *map(shlex.quote, command),
-                f">{shlex.quote(str(stdout_file))}",
-                f"2>{shlex.quote(str(stderr_file))}",
-            ]),
-        )
-        volumes = {
-            str(temp_dir): {"bind": str(temp_dir), "mode": "rw"},
-            **{
-                str(mount): {"bind": str(mount), "mode": "ro"}
-                for mount in readonly_binds
-            },
-            **{
-                str(host_dir): {"bind": str(container_dir), "mode": "ro"}
-                for host_dir, container_dir in readonly_mounts
-            },
-            **{
-                str(mount): {"bind": str(mount), "mode": "rw"}
-                for mount in readwrite_binds
-            },
-            **{
-                str(host_dir): {"bind": str(container_dir), "mode": "rw"}
-                for host_dir, container_dir in readwrite_mounts
-            },
-        }
-        container = docker_client().containers.run(
-            image,
-            real_command,
-            privileged=privileged,
-            mem_limit=mem_limit,
-            auto_remove=False,
-            detach=True,
-            nano_cpus=int(cpus * 1e9),
-            volumes=volumes,
-        )
-        start = datetime.datetime.now()
-        container.wait()
-        # while True:
-        #     try:
-        #         container.wait(timeout=1)
-        #         break
-        #     except requests.exceptions.ReadTimeout:
-        #         pass
-        container.remove(force=True)
-        time_output = (
-            resource_file.read_text().strip().split("\n")
-            if resource_file.exists()
-            else ""
-        )
-        stdout = stdout_file.read_bytes()
-        stderr = stderr_file.read_bytes()
-        try:
-            mem_kb, system_sec, user_sec, wall_time, exit_code = time_output[-1].split(" ")
-        except (ValueError, IndexError):
+    resource_file = temp_dir / "resources.txt"
+    time_output = (
+        resource_file.read_text().strip().split("\n")
+        if resource_file.exists()
+        else ""
+    )
+    stdout = HeadTailBuffer(max_output_size)
+    stdout.write_file(temp_dir / "stdout")
+    stderr = HeadTailBuffer(max_output_size)
+    stderr.write_file(temp_dir / "stderr")
+    usage = sampler.usage() if sampler is not None else None
+    try:
+        mem_kb, system_sec, user_sec, wall_time, exit_code = time_output[-1].split(" ")
+    except (ValueError, IndexError):
+        if usage is not None:
+            mem_kb = str(usage.max_memory // 1024)
+            system_sec = str(usage.system_cpu_time.total_seconds())
+            user_sec = str(usage.user_cpu_time.total_seconds())
+            wall_time = str(usage.wall_time.total_seconds())
+            warnings.warn(
+                f"Could not parse time output: {time_output!r}; using the container's cgroup instead"
+            )
+        else:
             mem_kb = "0"
             system_sec = "0.0"
             user_sec = "0.0"
             wall_time = "0.0"
-            exit_code = "0"
             warnings.warn(
                 f"Could not parse time output: {time_output!r}; setting those fields to 0"
             )
+        # `time` never finished, e.g., because the OOM killer got it, so the container's exit code is the best we have.
+        exit_code = str(128 + 9 if oom_killed else container_exit_code if container_exit_code is not None else 0)
     return CompletedContainer(
         docker_command=" && ".join([
             shlex.join(["mkdir", "-p", f"{temp_dir}"]),
-            shlex.join([
-                "docker",
-                "run",
-                f"--privileged={privileged!s}",
-                f"--memory={mem_limit}b",
-                f"--cpus={cpus:0.2f}",
-                *[
-                    f"--volume={host_dir}:{options['bind']}:{options['mode']}"
-                    for host_dir, options in volumes.items()
-                ],
-                image,
-                *real_command,
-            ]),
+            docker_command,
         ]),
         command=command,
         image=image,
         exit_code=int(exit_code),
         start=start,
-        stdout_b=stdout,
-        stderr_b=stderr,
+        stdout_b=stdout.getvalue(),
+        stderr_b=stderr.getvalue(),
+        stdout_size=stdout.size,
+        stderr_size=stderr.size,
+        stdout_hash=stdout.hash(),
+        stderr_hash=stderr.hash(),
         resource=ComputeResource(
             user_cpu_time=datetime.timedelta(seconds=float(user_sec)),
             system_cpu_time=datetime.timedelta(seconds=float(system_sec)),
             wall_time=datetime.timedelta(seconds=float(wall_time)),
             max_resident_set_size=int(mem_kb) * 1024,
+            max_virtual_memory_size=usage.max_virtual_memory_size if usage is not None else None,
+            io_bytes_read=usage.io_bytes_read if usage is not None else None,
+            io_bytes_written=usage.io_bytes_written if usage is not None else None,
+            scheduler_context_switches=usage.scheduler_context_switches if usage is not None else None,
+            time_series=usage.time_series if usage is not None and time_series_length else None,
         ),
     )
+
+
+def measure_docker_execution(
+        image: str,
+        command: tuple[str, ...],
+        *,
+        wall_time_limit: datetime.timedelta,
+        mem_limit: int,
+        cpus: float,
+        privileged: bool = False,
+        readonly_mounts: Iterable[tuple[pathlib.Path, pathlib.Path]] = (),
+        readwrite_mounts: Iterable[tuple[pathlib.Path, pathlib.Path]] = (),
+        readonly_binds: Iterable[pathlib.Path] = (),
+        readwrite_binds: Iterable[pathlib.Path] = (),
+        kill_after: datetime.timedelta = datetime.timedelta(seconds=120),
+        container_pool: ContainerPool | None = None,
+        sample_interval: datetime.timedelta | None = datetime.timedelta(seconds=1),
+        time_series_length: int = 0,
+        max_output_size: int | None = None,
+) -> CompletedContainer:
+    """Run command in a fresh container (or one from container_pool) and measure its resource usage.
+
+    If sample_interval is not None, the container's cgroup gets sampled at that interval,
+    which fills in the ComputeResource fields that `time` cannot (I/O, context switches),
+    and the ones that `time` could not, if it was killed before writing them.
+    If time_series_length, up to that many of the samples are kept in ComputeResource.time_series.
+
+    If max_output_size is not None, only the first and last max_output_size // 2 bytes of stdout and stderr are kept (see HeadTailBuffer);
+    stdout_size, stdout_hash, etc. still describe the whole stream.
+
+    """
+    sampler = CgroupSampler(sample_interval, time_series_length) if sample_interval is not None else None
+    with create_temp_dir() if container_pool is None else container_pool.temp_dir() as temp_dir:
+        # A fresh container's cgroup goes away when it exits, so the sampler needs it held open.
+        hold = sampler is not None and container_pool is None
+        real_command = _docker_real_command(command, temp_dir, wall_time_limit, kill_after)
+        oom_killed = False
+        if container_pool is not None:
+            volumes = _docker_volumes(container_pool.scratch_dir, readonly_mounts, readwrite_mounts, readonly_binds, readwrite_binds)
+            start = datetime.datetime.now()
+            container_exit_code, docker_command = container_pool.exec_run(
+                image,
+                real_command,
+                volumes=volumes,
+                mem_limit=mem_limit,
+                cpus=cpus,
+                privileged=privileged,
+                sampler=sampler,
+            )
+        else:
+            volumes = _docker_volumes(temp_dir, readonly_mounts, readwrite_mounts, readonly_binds, readwrite_binds)
+            # The held command waits for a file that a re-run would never create, so we record the plain one.
+            docker_command = _docker_run_command(image, real_command, volumes, privileged=privileged, mem_limit=mem_limit, cpus=cpus)
+            container = docker_client().containers.run(
+                image,
+                _docker_real_command(command, temp_dir, wall_time_limit, kill_after, hold=hold),
+                privileged=privileged,
+                mem_limit=mem_limit,
+                auto_remove=False,
+                detach=True,
+                nano_cpus=int(cpus * 1e9),
+                volumes=volumes,
+            )
+            start = datetime.datetime.now()
+            try:
+                with sampler.watch(container.id, whole_container=True) if sampler is not None else contextlib.nullcontext():
+                    if hold:
+                        _wait_held(container, temp_dir, _hold_deadline(start, wall_time_limit, kill_after))
+                if hold:
+                    (temp_dir / "release").touch()
+                container_exit_code = container.wait()["StatusCode"]
+                container.reload()
+                oom_killed = bool(container.attrs["State"].get("OOMKilled", False))
+            finally:
+                container.remove(force=True)
+        return _completed_container(
+            image,
+            command,
+            docker_command,
+            temp_dir,
+            start=start,
+            sampler=sampler,
+            time_series_length=time_series_length,
+            max_output_size=max_output_size,
+            container_exit_code=container_exit_code,
+            oom_killed=oom_killed,
+        )
+
+
+@contextlib.asynccontextmanager
+async def _docker_api_session() -> AsyncGenerator[tuple[aiohttp.ClientSession, str], None]:
+    """An aiohttp session connected to the same Docker daemon as docker_client(), and the base URL of its API."""
+    docker_kwargs = docker.utils.kwargs_from_env()
+    base_url = docker_kwargs.get("base_url", docker.constants.DEFAULT_UNIX_SOCKET)
+    tls = docker_kwargs.get("tls")
+    connector: aiohttp.BaseConnector
+    if base_url.startswith(("unix://", "http+unix://")):
+        connector = aiohttp.UnixConnector(path="/" + base_url.partition("://")[2].lstrip("/"))
+        url = "http://docker"
+    elif tls:
+        # Same certificates as docker-py's TLSConfig (DOCKER_CERT_PATH, DOCKER_TLS_VERIFY).
+        ssl_context = ssl.create_default_context(
+            cafile=tls.verify if isinstance(tls.verify, str) else tls.ca_cert if tls.verify else None,
+        )
+        if not tls.verify:
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+        if tls.cert:
+            ssl_context.load_cert_chain(*tls.cert)
+        connector = aiohttp.TCPConnector(ssl=ssl_context)
+        url = "https://" + base_url.partition("://")[2]
+    else:
+        connector = aiohttp.TCPConnector()
+        url = "http://" + base_url.partition("://")[2]
+    # Waiting on a container can take as long as the container runs.
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None)) as session:
+        yield session, url
+
+
+async def _create_container(session: aiohttp.ClientSession, url: str, config: Mapping[str, Any]) -> str:
+    async with session.post(f"{url}/containers/create", json=config) as response:
+        if response.status != 404:
+            response.raise_for_status()
+            return expect_type(str, (await response.json())["Id"])
+    # Like docker_client().containers.run, pull the image if we don't have it.
+    # docker-py sends the registry credentials from ~/.docker/config.json (X-Registry-Auth), which private registries need.
+    repository, tag = docker.utils.parse_repository_tag(config["Image"])
+    await asyncio.to_thread(docker_client().images.pull, repository, tag=tag or "latest")
+    async with session.post(f"{url}/containers/create", json=config) as response:
+        response.raise_for_status()
+        return expect_type(str, (await response.json())["Id"])
+
+
+async def _wait_container(session: aiohttp.ClientSession, url: str, container_id: str) -> int:
+    async with session.post(f"{url}/containers/{container_id}/wait") as response:
+        response.raise_for_status()
+        return expect_type(int, (await response.json())["StatusCode"])
+
+
+_T = TypeVar("_T")
+
+
+@contextlib.asynccontextmanager
+async def _enter_in_thread(context: ContextManager[_T]) -> AsyncGenerator[_T, None]:
+    """Enter and exit a blocking context manager in worker threads, so the event loop keeps running."""
+    value = await asyncio.to_thread(context.__enter__)
+    try:
+        yield value
+    except BaseException as exc:
+        if not await asyncio.to_thread(context.__exit__, type(exc), exc, exc.__traceback__):
+            raise
+    else:
+        await asyncio.to_thread(context.__exit__, None, None, None)
+
+
+async def measure_docker_execution_async(
+        image: str,
+        command: tuple[str, ...],
+        *,
+        wall_time_limit: datetime.timedelta,
+        mem_limit: int,
+        cpus: float,
+        privileged: bool = False,
+        readonly_mounts: Iterable[tuple[pathlib.Path, pathlib.Path]] = (),
+        readwrite_mounts: Iterable[tuple[pathlib.Path, pathlib.Path]] = (),
+        readonly_binds: Iterable[pathlib.Path] = (),
+        readwrite_binds: Iterable[pathlib.Path] = (),
+        kill_after: datetime.timedelta = datetime.timedelta(seconds=120),
+        sample_interval: datetime.timedelta | None = datetime.timedelta(seconds=1),
+        time_series_length: int = 0,
+        max_output_size: int | None = None,
+) -> CompletedContainer:
+    """Like measure_docker_execution, but waits on the container without blocking a thread.
+
+    This talks to the Docker HTTP API directly, so one event loop can drive many containers at once; e.g.,
+
+        for proc in asyncio.as_completed([measure_docker_execution_async(...), ...]):
+            print(await proc)
+
+    """
+    sampler = CgroupSampler(sample_interval, time_series_length) if sample_interval is not None else None
+    async with _enter_in_thread(create_temp_dir()) as temp_dir:
+        hold = sampler is not None
+        real_command = _docker_real_command(command, temp_dir, wall_time_limit, kill_after)
+        volumes = _docker_volumes(temp_dir, readonly_mounts, readwrite_mounts, readonly_binds, readwrite_binds)
+        config = {
+            "Image": image,
+            "Cmd": list(_docker_real_command(command, temp_dir, wall_time_limit, kill_after, hold=hold)),
+            "HostConfig": {
+                "Privileged": privileged,
+                "Memory": mem_limit,
+                "NanoCpus": int(cpus * 1e9),
+                "Binds": [
+                    f"{host_dir}:{options['bind']}:{options['mode']}"
+                    for host_dir, options in volumes.items()
+                ],
+            },
+        }
+        async with _docker_api_session() as (session, url):
+            container_id = await _create_container(session, url, config)
+            try:
+                async with session.post(f"{url}/containers/{container_id}/start") as response:
+                    response.raise_for_status()
+                start = datetime.datetime.now()
+                wait = asyncio.ensure_future(_wait_container(session, url, container_id))
+                async with _enter_in_thread(sampler.watch(container_id, whole_container=True) if sampler is not None else contextlib.nullcontext()):
+                    deadline = _hold_deadline(start, wall_time_limit, kill_after)
+                    # If the daemon dies, wait finishes with its error, which `await wait` raises below.
+                    while hold and not wait.done() and not (temp_dir / "finished").exists():
+                        if datetime.datetime.now() > deadline:
+                            wait.cancel()
+                            raise TimeoutError(f"Container {container_id} neither finished its command nor exited by {deadline}")
+                        await asyncio.sleep(0.05)
+                if hold:
+                    (temp_dir / "release").touch()
+                container_exit_code = await wait
+                async with session.get(f"{url}/containers/{container_id}/json") as response:
+                    response.raise_for_status()
+                    oom_killed = bool((await response.json())["State"].get("OOMKilled", False))
+            finally:
+                async with session.delete(f"{url}/containers/{container_id}", params={"force": "true"}):
+                    pass
+        # This reads the output files, which may be large.
+        return await asyncio.to_thread(
+            _completed_container,
+            image,
+            command,
+            _docker_run_command(image, real_command, volumes, privileged=privileged, mem_limit=mem_limit, cpus=cpus),
+            temp_dir,
+            start=start,
+            sampler=sampler,
+            time_series_length=time_series_length,
+            max_output_size=max_output_size,
+            container_exit_code=container_exit_code,
+            oom_killed=oom_killed,
+        )
@@ -1,16 +1,19 @@
+import concurrent.futures
 import datetime
 import shlex
 import pathlib
 import functools
+import threading
 from typing import Callable, Mapping, Optional, cast
 
 import json
 import chardet
 
+from ...config import cpu_budget
 from ...util import fs_escape, expect_type
 from ...types import Condition
 from ...conditions import TrisovicCondition, CodeCleaning
-from ..measure_command_execution import CompletedContainer, measure_docker_execution
+from ..measure_command_execution import CompletedContainer, ContainerPool, measure_docker_execution
 from .generic import WorkflowExecutor
 from .trisovic_code_cleaning import main as trisovic_code_cleaning
 from .grayson_code_cleaning import main as grayson_code_cleaning, generate_nix_flake
@@ -33,7 +36,32 @@ r_runner_images = {
 }
 
 
+@functools.cache
+def cpu_slots() -> threading.BoundedSemaphore:
+    """One slot per CPU in cpu_budget(), shared by every RLangExecutor call in this process."""
+    return threading.BoundedSemaphore(cpu_budget())
+
+
 class RLangExecutor(WorkflowExecutor):
+    """Runs every R script in the code, each in its own container.
+
+    The options come from the TrisovicCondition, so they are part of the cache key.
+
+    By default, each script loads the global state saved by the previous script (charmonium_state.RData),
+    so the scripts have to run one at a time, in order.
+
+    With share_state=False, scripts do not share state, so they may run concurrently.
+
+    With warm_containers=True, the commands for one code run in a few long-lived containers (see ContainerPool),
+    rather than each in a fresh container.
+
+    Only the first and last max_output_size // 2 bytes of each command's stdout and stderr are kept.
+
+    Every container takes a slot from cpu_slots() while it runs,
+    so all of the worker's threads together use at most cpu_budget() CPUs.
+
+    """
+
     def do_commands(
             self,
             code_dir: pathlib.Path,
@@ -42,6 +70,21 @@ class RLangExecutor(WorkflowExecutor):
             condition: Condition,
     ) -> tuple[CompletedContainer, ...]:
         condition = expect_type(TrisovicCondition, condition)
+        if condition.warm_containers:
+            with ContainerPool() as container_pool:
+                return self._do_commands(code_dir, out_dir, log_dir, condition, container_pool)
+        else:
+            return self._do_commands(code_dir, out_dir, log_dir, condition, None)
+
+    def _do_commands(
+            self,
+            code_dir: pathlib.Path,
+            out_dir: pathlib.Path,
+            log_dir: pathlib.Path,
+            condition: Condition,
+            container_pool: Optional[ContainerPool],
+    ) -> tuple[CompletedContainer, ...]:
+        condition = expect_type(TrisovicCondition, condition)
 
         r_files = sorted([*code_dir.glob("**/*.R"), *code_dir.glob("**/*.r")])
 
@@ -58,14 +101,15 @@ class RLangExecutor(WorkflowExecutor):
             r_source = r_file.read_bytes()
             encoding = expect_type(str, chardet.detect(r_source).get("encoding", "ascii"))
             state_name = "charmonium_state.RData"
-            r_file.write_bytes(
-                b"".join([
-                    f"load('{state_name}')\n".encode(encoding),
-                    r_source,
-                    f"save(list = ls(all.names = TRUE), file = '{state_name}', envir = .GlobalEnv)\n".encode(encoding),
-                    f"file.copy('{state_name}, '{r_file_result}/{state_name}')\n".encode(encoding),
-                ])
-            )
+            if condition.share_state:
+                r_file.write_bytes(
+                    b"".join([
+                        f"load('{state_name}')\n".encode(encoding),
+                        r_source,
+                        f"save(list = ls(all.names = TRUE), file = '{state_name}', envir = .GlobalEnv)\n".encode(encoding),
+                        f"file.copy('{state_name}, '{r_file_result}/{state_name}')\n".encode(encoding),
+                    ])
+                )
             r_file_result.mkdir()
             r_file_to_result[str(r_file.relative_to(code_dir))] = str(r_file_result.relative_to(out_dir))
 
@@ -80,15 +124,18 @@ class RLangExecutor(WorkflowExecutor):
             nix_flake = generate_nix_flake(packages, condition.r_version)
             (code_dir / "flake.nix").write_text(nix_flake)
             (out_dir / "flake.nix").write_text(nix_flake)
-            proc = measure_docker_execution(
-                r_runner_images[condition.r_version],
-                ("env", "--chdir", str(code_dir), *nix_command, "true"),
-                mem_limit=condition.mem_limit,
-                cpus=cpus,
-                readwrite_binds=(out_dir.parent, code_dir,),
-                # Double wall time limit because git cloning nixpkgs can take a while
-                wall_time_limit=condition.per_script_wall_time_limit * 2,
-            )
+            with cpu_slots():
+                proc = measure_docker_execution(
+                    r_runner_images[condition.r_version],
+                    ("env", "--chdir", str(code_dir), *nix_command, "true"),
+                    mem_limit=condition.mem_limit,
+                    cpus=cpus,
+                    readwrite_binds=(out_dir.parent, code_dir,),
+                    container_pool=container_pool,
+                    max_output_size=condition.max_output_size,
+                    # Double wall time limit because git cloning nixpkgs can take a while
+                    wall_time_limit=condition.per_script_wall_time_limit * 2,
+                )
             procs.append(proc)
             (out_dir / "nix").mkdir()
             (out_dir / "nix/stdout").write_bytes(proc.stdout_b)
@@ -108,15 +155,18 @@ class RLangExecutor(WorkflowExecutor):
             # Even if this fails, we still want to try out the script.
             # We could have incorrectly parsed something that isn't really a package.
             # The script might not need the package they install.
-            proc = measure_docker_execution(
-                r_runner_images[condition.r_version],
-                ("env", "--chdir", str(code_dir), "Rscript", "charmonium_init.R"),
-                mem_limit=condition.mem_limit,
-                cpus=cpus,
-                readwrite_binds=(out_dir.parent, code_dir,),
-                # Double wall time limit because installing can take a while
-                wall_time_limit=condition.per_script_wall_time_limit * 2,
-            )
+            with cpu_slots():
+                proc = measure_docker_execution(
+                    r_runner_images[condition.r_version],
+                    ("env", "--chdir", str(code_dir), "Rscript", "charmonium_init.R"),
+                    mem_limit=condition.mem_limit,
+                    cpus=cpus,
+                    readwrite_binds=(out_dir.parent, code_dir,),
+                    container_pool=container_pool,
+                    max_output_size=condition.max_output_size,
+                    # Double wall time limit because installing can take a while
+                    wall_time_limit=condition.per_script_wall_time_limit * 2,
+                )
             procs.append(proc)
             (out_dir / "install").mkdir()
             (out_dir / "install/stdout").write_bytes(proc.stdout_b)
@@ -128,17 +178,20 @@ class RLangExecutor(WorkflowExecutor):
         failed = r_files
         new_successes = True
         order_file = out_dir / "order.txt"
-        order = []
+        order: list[str] = []
 
         
-        proc = measure_docker_execution(
-            r_runner_images[condition.r_version],
-            ("env", "--chdir", str(code_dir), *nix_command, "Rscript", "-e", f"save(list = c(), file = '{state_name}', envir = .GlobalEnv)"),
-            mem_limit=condition.mem_limit,
-            cpus=cpus,
-            readwrite_binds=(out_dir.parent, code_dir,),
-            wall_time_limit=condition.per_script_wall_time_limit,
-        )
+        with cpu_slots():
+            proc = measure_docker_execution(
+                r_runner_images[condition.r_version],
+                ("env", "--chdir", str(code_dir), *nix_command, "Rscript", "-e", f"save(list = c(), file = '{state_name}', envir = .GlobalEnv)"),
+                mem_limit=condition.mem_limit,
+                cpus=cpus,
+                readwrite_binds=(out_dir.parent, code_dir,),
+                container_pool=container_pool,
+                max_output_size=condition.max_output_size,
+                wall_time_limit=condition.per_script_wall_time_limit,
+            )
         (out_dir / "init").mkdir()
         (out_dir / "init/stdout").write_bytes(proc.stdout_b)
         (out_dir / "init/stderr").write_bytes(proc.stderr_b)
@@ -149,25 +202,39 @@ class RLangExecutor(WorkflowExecutor):
         if proc.exit_code != 0:
             return tuple(procs)
 
-        while new_successes:
-            new_failures = []
-            new_successes = False
-            for r_file in failed:
-                r_file_result = out_dir / pathlib.Path(r_file_to_result[str(r_file.relative_to(code_dir))])
-                order.append(str(r_file.relative_to(code_dir)))
+        def run_script(r_file: pathlib.Path) -> CompletedContainer:
+            r_file_result = out_dir / pathlib.Path(r_file_to_result[str(r_file.relative_to(code_dir))])
+            with cpu_slots():
                 proc = measure_docker_execution(
                     r_runner_images[condition.r_version],
                     ("env", "--chdir", str(code_dir), *nix_command, "Rscript", str(r_file)),
                     mem_limit=condition.mem_limit,
                     cpus=cpus,
                     readwrite_binds=(out_dir.parent, code_dir,),
+                    container_pool=container_pool,
+                    max_output_size=condition.max_output_size,
                     wall_time_limit=condition.per_script_wall_time_limit,
                 )
-                (r_file_result / "stdout").write_bytes(proc.stdout_b)
-                (r_file_result / "stderr").write_bytes(proc.stderr_b)
-                (r_file_result / "exit_code").write_text(str(proc.exit_code))
-                (r_file_result / "name").write_text(str(r_file.relative_to(code_dir)))
-                (r_file_result / "command.sh").write_text(proc.docker_command)
+            (r_file_result / "stdout").write_bytes(proc.stdout_b)
+            (r_file_result / "stderr").write_bytes(proc.stderr_b)
+            (r_file_result / "exit_code").write_text(str(proc.exit_code))
+            (r_file_result / "name").write_text(str(r_file.relative_to(code_dir)))
+            (r_file_result / "command.sh").write_text(proc.docker_command)
+            return proc
+
+        # Scripts which share state depend on the previous script's state, so they must run sequentially.
+        max_concurrent_scripts = max(1, cpu_budget() // cpus) if not condition.share_state else 1
+
+        while new_successes:
+            new_failures = []
+            new_successes = False
+            order.extend(str(r_file.relative_to(code_dir)) for r_file in failed)
+            if max_concurrent_scripts > 1:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent_scripts) as executor:
+                    round_procs = list(executor.map(run_script, failed))
+            else:
+                round_procs = [run_script(r_file) for r_file in failed]
+            for r_file, proc in zip(failed, round_procs):
                 procs.append(proc)
                 if proc.exit_code == 0:
                     new_successes = True
@@ -12,14 +12,14 @@ import charmonium.time_block
 import requests
 
 from ..config import harvard_dataverse_token, ssl_context
-from ..types import Code
+from ..types import Code, Fingerprinted
 
 # TODO: download a Zip archive of the whole dataset instead of downloading each file individually.
 
 retries = 3
 
 @dataclasses.dataclass(frozen=True)
-class DataverseDataset(Code):
+class DataverseDataset(Code, Fingerprinted):
     persistent_id: str
     server = "http://dataverse.harvard.edu/api/"
 
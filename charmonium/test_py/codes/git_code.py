@@ -8,12 +8,12 @@ from typing import Iterable, Optional
 
 import git
 
-from ..types import Code
+from ..types import Code, Fingerprinted
 from ..util import create_temp_dir
 
 
 @dataclasses.dataclass(frozen=True)
-class GitCode(Code):
+class GitCode(Code, Fingerprinted):
     repo_url: str
     rev: str
     tag_name: Optional[str] = None
@@ -9,13 +9,13 @@ from typing import Iterable, Optional, Mapping, Any
 
 import github
 
-from ..types import Code
+from ..types import Code, Fingerprinted
 from .git_code import GitCode
 from ..config import github_client
 
 
 @dataclasses.dataclass(frozen=True)
-class GitHubCode(Code):
+class GitHubCode(Code, Fingerprinted):
     _user: str
     _repo: str
     _commit: str
@@ -1,10 +1,10 @@
 import dataclasses
 import pathlib
 
-from ..types import Code
+from ..types import Code, Fingerprinted
 
 @dataclasses.dataclass(frozen=True)
-class WorkflowCode(Code):
+class WorkflowCode(Code, Fingerprinted):
     code: Code
     executor: str
 
@@ -20,6 +20,10 @@ class TrisovicCondition(WorkflowCondition):
     r_version: str
     code_cleaning: CodeCleaning
     per_script_wall_time_limit: datetime.timedelta
+    # These change what the scripts see or what we record about them, so they belong in the cache key.
+    share_state: bool = True
+    warm_containers: bool = False
+    max_output_size: Optional[int] = 4 * 1024**2
 
     @property
     def use_nix(self) -> bool:
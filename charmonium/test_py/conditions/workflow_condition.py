@@ -1,10 +1,10 @@
 import datetime
 import dataclasses
 
-from ..types import Condition
+from ..types import Condition, Fingerprinted
 
 
 @dataclasses.dataclass(frozen=True)
-class WorkflowCondition(Condition):
+class WorkflowCondition(Condition, Fingerprinted):
     mem_limit: int
     wall_time_limit: datetime.timedelta
@@ -94,6 +94,11 @@ def harvard_dataverse_token() -> str:
     return os.environ.get("HARVARD_DATAVERSE_TOKEN", "")
 
 
+def cpu_budget() -> int:
+    """CPUs that the workflows in one worker process may use at once, shared by all of its threads."""
+    return int(os.environ.get("CPU_BUDGET", os.cpu_count() or 1))
+
+
 @functools.cache
 def docker_client() -> docker.DockerClient:
     return docker.from_env()
@@ -235,7 +240,20 @@ def memoized_group() -> charmonium.cache.MemoizedGroup:
         ("charmonium.test_py.config", "AzureSyncCredential"),
         ("aiofiles.base", "AiofilesContextManager"),
         ("random", "Random"),
+        # RLangExecutor is stateless; its options live on the TrisovicCondition, which is frozen.
         ("charmonium.test_py.analyses.workflow_executors.r_lang", "RLangExecutor"),
+        # Threads and thread pools don't affect results, but freezing them recurses through all of threading.
+        ("threading", "Thread"),
+        ("concurrent.futures.thread", "ThreadPoolExecutor"),
+        # Freezing a UPath walks its filesystem object and credentials.
+        ("upath.core", "UPath"),
+        # E.g., the lock of util.temp_dir_pool.
+        ("_thread", "lock"),
+        # E.g., the queue of util.reaper (a Queue holds Conditions).
+        ("queue", "Queue"),
+        ("threading", "Condition"),
+        # util._hash_cache only remembers hashes of files, so it doesn't affect results.
+        ("charmonium.test_py.util", "_HashCache"),
     })
     freeze_config.ignore_objects_by_class.update({
         ("charmonium.time_block.time_block", "TimeBlock"),
@@ -262,6 +280,7 @@ def memoized_group() -> charmonium.cache.MemoizedGroup:
         ("charmonium.test_py.analyses.execute_workflow", "analyze"),
         ("dask.base", "compute"),
         ("charmonium.test_py.util", "create_temp_dir"),
+        ("charmonium.test_py.config", "data_path"),
         ("charmonium.test_py.analyses.workflow_executors.r_lang", "get_container"),
 
         # I promise to always seed random before sampling, therefore avoiding the dependenc on global state.
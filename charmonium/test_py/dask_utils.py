@@ -1,12 +1,14 @@
+import concurrent.futures
 import datetime
 import random
 import pathlib
-from typing import TYPE_CHECKING, Callable, TypeVar, Optional, cast
+from typing import TYPE_CHECKING, Any, Callable, Iterable, TypeVar, Optional, cast
 from typing_extensions import ParamSpec
 import functools
 import subprocess
 
 import charmonium.cache
+import charmonium.freeze
 
 from . import config
 from .util import create_temp_dir
@@ -37,3 +39,57 @@ def call_if_cached(func: charmonium.cache.Memoized[Params, Return], *args: Param
         else:
             hit, value = True, cast(Return, entry.value)
     return hit, value
+
+
+def call_many_if_cached(
+        func: charmonium.cache.Memoized[Params, Return],
+        arg_tuples: Iterable[tuple[Any, ...]],
+        parallelism: int = 16,
+) -> list[tuple[bool, Optional[Return]]]:
+    """Like call_if_cached, but for many calls to the same function.
+
+    The parts of the key that don't depend on the arguments get
+    frozen once, the index gets read once, and the hits get fetched
+    from the object store and unpickled in parallel.
+
+    """
+
+    call_id = random.randint(0, 2**64 - 1)
+    group = func.group
+    freeze_config = group._freeze_config
+    shared_key = (
+        charmonium.freeze.freeze(group._system_state(), freeze_config),
+        charmonium.freeze.freeze(func.name, freeze_config),
+        charmonium.freeze.freeze(func._func_state(), freeze_config),
+    )
+    keys = [
+        (
+            *shared_key,
+            charmonium.freeze.freeze(func._args2key(*args), freeze_config),
+            charmonium.freeze.freeze(func._args2ver(*args), freeze_config),
+        )
+        for args in arg_tuples
+    ]
+    with group._memory_lock:
+        if group._fine_grain_persistence:
+            group._index_read(call_id)
+        entries = [group._index.get(key, None) for key in keys]
+
+    def lookup(key: tuple[Any, ...], entry: Any) -> tuple[bool, Optional[Return]]:
+        if entry is None:
+            return False, None
+        elif entry.obj_store:
+            obj_key = cast(int, charmonium.freeze.freeze(key, freeze_config))
+            value_ser = group._obj_store.get(obj_key, None)
+            if value_ser is not None:
+                return func._try_unpickle(value_ser, call_id)
+            else:
+                return False, None
+        else:
+            return True, cast(Return, entry.value)
+
+    n_fetches = sum(1 for entry in entries if entry is not None and entry.obj_store)
+    if n_fetches <= 1:
+        return list(map(lookup, keys, entries))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(parallelism, n_fetches)) as executor:
+        return list(executor.map(lookup, keys, entries))
@@ -2,6 +2,7 @@ import random
 import pickle
 import dataclasses
 import itertools
+import collections
 from typing import Iterable, TypeVar, Any, Callable, Mapping, cast, TYPE_CHECKING, Optional
 
 import toolz  # type: ignore
@@ -11,6 +12,7 @@ import dask
 import distributed
 
 from .util import create_temp_dir, flatten1, expect_type, return_args
+from .dask_utils import call_many_if_cached
 from .types import Code, Result, Condition, Registry, Analysis, Reduction, ReducedResult
 from . import config
 
@@ -61,7 +63,20 @@ def stream_results(
         dask_client: distributed.Client,
         experimental_config: Config,
         randomize_dispatch_order: bool = False,
-) -> tuple[int, Iterable[tuple[Code, Condition, ReducedResult | Exception]]]:
+        max_in_flight: Optional[int] = None,
+        probe_cache: bool = True,
+        probe_batch_size: Optional[int] = None,
+) -> tuple[int, Iterable[tuple[Code, Condition, int, ReducedResult | Exception]]]:
+    """Dispatch every job in experimental_config and stream (code, condition, iteration, result) back as they complete.
+
+    If max_in_flight is given, at most that many futures are outstanding at once;
+    another job is submitted each time one completes. Otherwise, all jobs are submitted up-front.
+
+    If probe_cache, jobs which would hit in the cache are answered on the client and never submitted.
+    Jobs get probed probe_batch_size (default: max_in_flight) at a time, since each probe reads the whole index,
+    and the misses get queued up for submission.
+
+    """
     codes = list(flatten1(
         get_codes(registry)
         for registry in experimental_config.registries
@@ -70,50 +85,74 @@ def stream_results(
         random.seed(experimental_config.seed)
         codes = random.sample(codes, experimental_config.sample_size)
 
+    conditions = experimental_config.conditions
+    n_repetitions = experimental_config.n_repetitions
+    n_futures = len(codes) * len(conditions) * n_repetitions
+
+    # Job i is the ith element of itertools.product(codes, conditions, range(n_repetitions)).
+    # We pass around indices rather than the product itself, so we never have to materialize it.
+    def job_args(job_idx: int) -> tuple[Reduction, Analysis, Code, Condition, int]:
+        code_idx, rest = divmod(job_idx, len(conditions) * n_repetitions)
+        condition_idx, iteration = divmod(rest, n_repetitions)
+        return (
+            experimental_config.reduction,
+            experimental_config.analysis,
+            codes[code_idx],
+            conditions[condition_idx],
+            iteration,
+        )
+
     # Randomly shuffling means that we don't get A0, A1, ..., A100, B0, B1, ... B100, C0, ...
     # If the analysis is robust to missing data, and requires diverse data (not all A's), it is better to randomize this order
-    product_args = list(itertools.product(
-        [experimental_config.reduction],
-        [experimental_config.analysis],
-        codes,
-        experimental_config.conditions,
-        range(experimental_config.n_repetitions),
-    ))
+    job_idxs: Iterable[int] = range(n_futures)
     if randomize_dispatch_order:
         random.seed(experimental_config.seed)
-        random.shuffle(product_args)
-
-    reductions: Iterable[Reduction]
-    analyses: Iterable[Analysis]
-    codes2: Iterable[Code]
-    conditions: Iterable[Condition]
-    iterations: Iterable[int]
-    reductions, analyses, codes2, conditions, iterations = zip(*product_args)
+        job_idxs = random.sample(range(n_futures), n_futures)
 
-    # Put one argument through tqdm to get a progress bar
-    # As each code gets consumed, we know one job was submitted
-    n_futures = len(codes) * len(experimental_config.conditions) * experimental_config.n_repetitions
-    codes3 = tqdm.tqdm(codes2, desc="Jobs submitted", total=n_futures)
+    # As each index gets consumed, we know one job was probed (and either found in the cache or queued for submission)
+    pending_job_idxs = iter(tqdm.tqdm(job_idxs, desc="Jobs dispatched", total=n_futures))
 
+    func = return_args(reduced_analysis)
+    futures = distributed.as_completed([], with_results=True)  # type: ignore
     stream = cast(
         Iterable[tuple[Any, tuple[tuple[Reduction, Analysis, Code, Condition, int], Mapping[str, Any], ReducedResult | Exception]]],
-        distributed.as_completed(  # type: ignore
-            dask_client.map(
-                return_args(reduced_analysis),
-                reductions,
-                analyses,
-                codes3,
-                conditions,
-                iterations,
-            ),  # type: ignore
-            with_results=True,
-        ),
+        futures,
     )
-    stream2 = (
-        (code, condition, result)
-        for future, ((reduction, analysis, code, condition, iteration), kwargs, result) in stream
-    )
-    return n_futures, stream2
+
+    if probe_batch_size is None:
+        probe_batch_size = n_futures if max_in_flight is None else max_in_flight
+
+    # Jobs which are known to miss in the cache, waiting for a slot.
+    misses: collections.deque[tuple[Reduction, Analysis, Code, Condition, int]] = collections.deque()
+
+    def refill(n_slots: int) -> Iterable[tuple[Code, Condition, int, ReducedResult | Exception]]:
+        """Submit up to n_slots more jobs, yielding the ones that hit in the cache instead of submitting them."""
+        while n_slots > 0:
+            if not misses:
+                chunk = [job_args(job_idx) for job_idx in itertools.islice(pending_job_idxs, max(probe_batch_size, 1) if probe_cache else n_slots)]
+                if not chunk:
+                    break
+                if probe_cache:
+                    probes = call_many_if_cached(reduced_analysis, chunk)
+                else:
+                    probes = [(False, None)] * len(chunk)
+                for args, (hit, result) in zip(chunk, probes):
+                    if hit:
+                        yield (args[2], args[3], args[4], cast(ReducedResult | Exception, result))
+                    else:
+                        misses.append(args)
+            while n_slots > 0 and misses:
+                futures.add(dask_client.submit(func, *misses.popleft()))  # type: ignore
+                n_slots -= 1
+
+    def stream2() -> Iterable[tuple[Code, Condition, int, ReducedResult | Exception]]:
+        yield from refill(n_futures if max_in_flight is None else max_in_flight)
+        for future, ((reduction, analysis, code, condition, iteration), kwargs, result) in stream:
+            # Refill the window before yielding, so the cluster stays busy while the caller processes this result.
+            yield from refill(1)
+            yield (code, condition, iteration, result)
+
+    return n_futures, stream2()
 
 
 @charmonium.cache.memoize(group=config.memoized_group())
@@ -129,12 +168,7 @@ def get_results(
         random.seed(experimental_config.seed)
         codes = random.sample(codes, experimental_config.sample_size)
 
-    reductions: Iterable[Reduction]
-    analyses: Iterable[Analysis]
-    codes2: Iterable[Code]
-    conditions: Iterable[Condition]
-    iterations: Iterable[int]
-    reductions, analyses, codes2, conditions, iterations = zip(*itertools.product(
+    product_args = list(itertools.product(
         [experimental_config.reduction],
         [experimental_config.analysis],
         codes,
@@ -142,20 +176,15 @@ def get_results(
         range(experimental_config.n_repetitions),
     ))
 
-    return cast(
-        list[tuple[Code, Condition, ReducedResult | Exception]],
-        list(
-            zip(
-                codes2,
-                conditions,
-                dask.compute(*map(  # type: ignore
-                    dask.delayed(reduced_analysis),  # type: ignore
-                    reductions,
-                    analyses,
-                    codes2,
-                    conditions,
-                    iterations,
-                )),
-            ),
-        ),
-    )
+    # Only ship the misses to the cluster; hits can be answered right here.
+    probes = call_many_if_cached(reduced_analysis, product_args)
+    misses = [args for args, (hit, _) in zip(product_args, probes) if not hit]
+    miss_results = iter(dask.compute(*(  # type: ignore
+        dask.delayed(reduced_analysis)(*args)  # type: ignore
+        for args in misses
+    )))
+
+    return [
+        (code, condition, cast(ReducedResult | Exception, result if hit else next(miss_results)))
+        for (reduction, analysis, code, condition, iteration), (hit, result) in zip(product_args, probes)
+    ]
@@ -1,3 +1,4 @@
+from __future__ import annotations
 import json
 import csv
 import enum
@@ -13,6 +14,9 @@ import re
 import warnings
 import datetime
 import itertools
+import threading
+import shutil
+import contextlib
 from typing import Iterable, TypeVar, Any, Callable, Mapping, Sequence, Optional, IO, cast, TYPE_CHECKING
 
 import yaml
@@ -26,12 +30,13 @@ from .main import  stream_results, get_results, Config, reduced_analysis, analyz
 from .registries import DataverseTrisovicFixed
 from .conditions import TrisovicCondition, CodeCleaning
 from .analyses.file_bundle import File
+from .analyses.measure_command_execution import CompletedContainer
 from .codes.dataverse_dataset import HashMismatchError
 from .codes import WorkflowCode, DataverseDataset
 from .analyses import ExecuteWorkflow, WorkflowExecution
 from .conditions import TrisovicCondition
-from .util import create_temp_dir, flatten1, expect_type, clear_cache, find_last, is_not_none, shorten_lines
-from .types import Code, Result, Condition, Registry, Analysis, ReducedResult, Reduction
+from .util import create_temp_dir, flatten1, expect_type, clear_cache, find_last, is_not_none, shorten_lines, atomic_write_text
+from .types import Code, Result, Condition, Registry, Analysis, ReducedResult, Reduction, Fingerprinted
 from . import config
 
 
@@ -79,12 +84,12 @@ class MyReducedResult(ReducedResult):
     missing_files: tuple[pathlib.Path, ...]
 
 
-class MyReduction(Reduction):
+class MyReduction(Reduction, Fingerprinted):
     def reduce(self, code: Code, condition: Condition, result: Result) -> MyReducedResult:
         if isinstance(result, WorkflowExecution):
             script_results: dict[str, ScriptResult] = {}
             missing_files: list[pathlib.Path] = []
-            if (index_file := result.outputs.files.get(pathlib.Path("index.json"), None)) and index_file is not None and (contents := index_file.contents) and contents is not None:
+            if (index_file := result.outputs.files.get(pathlib.Path("index.json"), None)) and index_file is not None and (contents := index_file.read_bytes()) and contents is not None:
                 results_map = json.loads(contents)
             else:
                 results_map = {}
@@ -96,15 +101,15 @@ class MyReduction(Reduction):
                     missing_files.extend(this_missing_files)
                     continue
                 if (exit_code_file := result.outputs.files.get(results_path / "exit_code", None)) is not None:
-                    exit_code = int(expect_type(bytes, exit_code_file.contents).decode())
+                    exit_code = int(expect_type(bytes, exit_code_file.read_bytes()).decode())
                 else:
                     exit_code = 137
-                stderr = expect_type(bytes, result.outputs.files[results_path / "stderr"].contents).decode(errors="backslashreplace")
-                stdout = expect_type(bytes, result.outputs.files[results_path / "stdout"].contents).decode(errors="backslashreplace")
+                # parse_events needs all of stderr, but stdout only needs its first and last lines.
+                stderr = expect_type(bytes, result.outputs.files[results_path / "stderr"].read_bytes()).decode(errors="backslashreplace")
                 script_results[r_file] = ScriptResult(
                     exit_code=exit_code,
                     stderr=shorten_lines(stderr, 20, 60),
-                    stdout=shorten_lines(stdout, 20, 60),
+                    stdout=result.outputs.files[results_path / "stdout"].shorten_lines(20, 60),
                     events=parse_events(stderr),
                 )
             detailed_result = MyReducedResult(
@@ -125,9 +130,10 @@ def print_result(result: WorkflowExecution, fobj: None | IO[str] = None) -> None
     for label, filebundle in [("outputs", result.outputs), ("logs", result.logs)]:
         print(f"  {label}", file=fobj)
         for path, file in filebundle.files.items():
-            contents = file.contents
-            if contents is not None:
-                printable_contents = contents[:1000].decode(errors="backslashreplace")
+            if file.contents is not None or file.contents_ref is not None:
+                # Blobs can be large, so we only read what we print.
+                with file.open() as fileobj:
+                    printable_contents = fileobj.read(1000).decode(errors="backslashreplace")
             else:
                 printable_contents = ""
             print(
@@ -184,69 +190,91 @@ def get_experimental_status(
             raise TypeError(type(result))
 
 
-def parse_events(error_text: str) -> tuple[Event, ...]:
-    error_regexes = {
-        "r_error": re.compile(
-            r"Error(?: in (?P<loc>.*) )?:\s+(?P<msg>\S.*)\n\s*(?:Calls: (?P<calls>.*)\n)?(?:In addition: (?P<in_addition>.*)\nIn (?P<in_addition_loc>.*) :(?:\n  | )(?P<in_addition_msg>.*)\n)?Execution halted",
-            re.MULTILINE,
-        ),
-        "r_warnings": re.compile(
-            r"Warning messages:\n(?P<warnings>(?:\d+: In .* :\s+.*\n)*)",
-            re.MULTILINE
-        ),
-        "r_warning": re.compile(
-            r"^Warning(?: message:)?(?:\s+[Ii]n (?P<loc>.*))?\s+:\s+(?P<msg>[a-z0-9].*)",
-            # Need to exclude "Warning: Fortran ...". R warnings seem always lowercase.
-            re.MULTILINE
-        ),
-        "gcc_fatal_error": re.compile(
-            r"(?P<file>.*):(?P<line>\d+):(?P<col>\d+): fatal error: (?P<msg>.*)\n(?P<source>[\s\S]*)\ncompilation terminated",
-            re.MULTILINE,
-        ),
-        "configure_error": re.compile(r"(?P<configure_script>./config(?:ure|.status)): line (?P<line>\d+): (?P<msg>.*)"),
-        "make_error": re.compile(
-            r"make: \*\*\* \[(?P<makefile>.+):(?P<line>\d+): (?P<target>.*)\] Error (?P<exit_code>\d+)"
-        ),
-        "ld_error": re.compile(
-            r"(?P<ld_path>/[a-zA-Z0-9/]+/ld): (?P<msg>.*)"
-        ),
-        "r_warning_count": re.compile(r"\nThere were (?P<num_warnings>\d+) warnings"),
-        "r_other_error": re.compile(r"ERROR: '(?P<msg>.*)'"),
-        "sigkill": re.compile(r"Killed!"),
-        "install_r_package": re.compile(r"\* installing \*(?P<type>.*)\* package '(?P<package>.*)' ..."),
-        "loaded_r_package": re.compile(r"Loading required package: (?P<package>.*)"),
-    }
+# Each regex is paired with a literal that occurs in every match of that regex, on the same line as the start of the match.
+# See finditer_with_literal for how this is used.
+event_regexes: Mapping[str, tuple[str, re.Pattern[str]]] = {
+    "r_error": ("Error", re.compile(
+        r"Error(?: in (?P<loc>.*) )?:\s+(?P<msg>\S.*)\n\s*(?:Calls: (?P<calls>.*)\n)?(?:In addition: (?P<in_addition>.*)\nIn (?P<in_addition_loc>.*) :(?:\n  | )(?P<in_addition_msg>.*)\n)?Execution halted",
+        re.MULTILINE,
+    )),
+    "r_warnings": ("Warning messages:\n", re.compile(
+        r"Warning messages:\n(?P<warnings>(?:\d+: In .* :\s+.*\n)*)",
+        re.MULTILINE
+    )),
+    "r_warning": ("Warning", re.compile(
+        r"^Warning(?: message:)?(?:\s+[Ii]n (?P<loc>.*))?\s+:\s+(?P<msg>[a-z0-9].*)",
+        # Need to exclude "Warning: Fortran ...". R warnings seem always lowercase.
+        re.MULTILINE
+    )),
+    "gcc_fatal_error": (": fatal error: ", re.compile(
+        r"(?P<file>.*):(?P<line>\d+):(?P<col>\d+): fatal error: (?P<msg>.*)\n(?P<source>[\s\S]*)\ncompilation terminated",
+        re.MULTILINE,
+    )),
+    "configure_error": ("/config", re.compile(r"(?P<configure_script>./config(?:ure|.status)): line (?P<line>\d+): (?P<msg>.*)")),
+    "make_error": ("make: *** [", re.compile(
+        r"make: \*\*\* \[(?P<makefile>.+):(?P<line>\d+): (?P<target>.*)\] Error (?P<exit_code>\d+)"
+    )),
+    "ld_error": ("/ld: ", re.compile(
+        r"(?P<ld_path>/[a-zA-Z0-9/]+/ld): (?P<msg>.*)"
+    )),
+    "r_warning_count": ("\nThere were ", re.compile(r"\nThere were (?P<num_warnings>\d+) warnings")),
+    "r_other_error": ("ERROR: '", re.compile(r"ERROR: '(?P<msg>.*)'")),
+    "sigkill": ("Killed!", re.compile(r"Killed!")),
+    "install_r_package": ("* installing *", re.compile(r"\* installing \*(?P<type>.*)\* package '(?P<package>.*)' ...")),
+    "loaded_r_package": ("Loading required package: ", re.compile(r"Loading required package: (?P<package>.*)")),
+}
+
+
+r_error_regexes: Mapping[str, tuple[str, re.Pattern[str]]] = {
+    "no such function": ("could not find function \"", re.compile(r"could not find function \"(?P<function>.*)\"")),
+    "no such package": ("there is no package called '", re.compile(r"there is no package called '(?P<package>.*)'")),
+    "installation of package failed": ("' had non-zero exit status", re.compile(r"installation of package '(?P<package>.*)' had non-zero exit status")),
+    "cannot open the connection": ("cannot open the connection", re.compile(r"cannot open the connection")),
+    "cannot open compressed file": ("cannot open compressed file '", re.compile(r"cannot open compressed file '(?P<file>.*)', probable reason '(?P<reason>.*)'")),
+    "package is not available": ("' is not available (for R version ", re.compile(r"package '(?P<package>.*)' is not available \(for R version (?P<r_ver>.*)\)")),
+}
 
-    r_error_regexes = {
-        "no such function": re.compile(r"could not find function \"(?P<function>.*)\""),
-        "no such package": re.compile(r"there is no package called '(?P<package>.*)'"),
-        "installation of package failed": re.compile(r"installation of package '(?P<package>.*)' had non-zero exit status"),
-        "cannot open the connection": re.compile(r"cannot open the connection"),
-        "cannot open compressed file": re.compile(r"cannot open compressed file '(?P<file>.*)', probable reason '(?P<reason>.*)'"),
-        "package is not available": re.compile(r"package '(?P<package>.*)' is not available \(for R version (?P<r_ver>.*)\)"),
-    }
 
+def finditer_with_literal(regex: re.Pattern[str], literal: str, text: str) -> Iterable[re.Match[str]]:
+    """Equivalent to regex.finditer(text), given that literal occurs on the first line of every match of regex.
+
+    Finding the literal is a fast substring search, much cheaper than a regex scan,
+    so we can skip straight to the line of the next occurrence of the literal, since no match can start before it.
+    This matters most for patterns like gcc_fatal_error, which begin with `.*` and backtrack on every line.
+    Most stderrs only contain a few kinds of events, so most regexes get skipped altogether.
+
+    """
+    pos = 0
+    while (literal_start := text.find(literal, pos)) != -1:
+        match = regex.search(text, max(pos, text.rfind("\n", 0, literal_start) + 1))
+        if match is None:
+            break
+        yield match
+        pos = match.end()
+
+
+def parse_events(error_text: str) -> tuple[Event, ...]:
     events: list[tuple[int, Event]] = []
-    for error_kind, error_regex in error_regexes.items():
-        for match in error_regex.finditer(error_text):
+    for error_kind, (error_literal, error_regex) in event_regexes.items():
+        for match in finditer_with_literal(error_regex, error_literal, error_text):
             params = match.groupdict()
             if error_kind == "r_warnings":
                 warnings.warn("When r_warnings are coalesced, they are also unparsed.")
                 # In principle, we could parse these into individual warnings here.
             elif error_kind == "r_error" or error_kind == "r_warning":
                 # replace "msg" with a more parsed alternative
-                for r_error_kind, r_error_regex in r_error_regexes.items():
-                    if (match2 := r_error_regex.search(match.group("msg"))) is not None:
+                msg = match.group("msg")
+                for r_error_kind, (r_error_literal, r_error_regex) in r_error_regexes.items():
+                    if r_error_literal in msg and (match2 := r_error_regex.search(msg)) is not None:
                         for key, val in match2.groupdict().items():
                             params[key] = val
                         params["subkind"] = r_error_kind
                         del params["msg"]
                         break
             events.append((match.start(), Event(error_kind, params)))
-    return cast(
-        tuple[Event, ...],
-        tuple(map(toolz.second, sorted(events))),
-    )
+    # Sort by start only; Events are not orderable.
+    events.sort(key=toolz.first)
+    return tuple(map(toolz.second, events))
 
 
 orig_work_dict = {
@@ -457,16 +485,237 @@ def compare_with_orig(
     raise NotImplementedError
 
 
+execution_class_priority = (ExecutionClass.success, ExecutionClass.timed_out, ExecutionClass.failure, ExecutionClass.unknown)
+
+
+def best_execution_class(execution_classes: Iterable[ExecutionClass]) -> ExecutionClass:
+    """Success if any succeeded, else timed out if any timed out, else failure if any failed, else unknown."""
+    return min(execution_classes, key=execution_class_priority.index, default=ExecutionClass.unknown)
+
+
+def execution_class_categorical(execution_classes: Iterable[ExecutionClass]) -> pandas.Categorical:
+    """Ordered so that the min of a group is its best_execution_class."""
+    return pandas.Categorical(list(execution_classes), categories=execution_class_priority, ordered=True)
+
+
+def result_signature(result: ScriptResult) -> tuple[int, str, str]:
+    """Two iterations are considered the same if their signatures are the same."""
+    return (
+        result.exit_code,
+        "\n".join(result.stdout.split("\n")[-5:]),
+        "\n".join(result.stderr.split("\n")[-5:]),
+    )
+
+
+class ScriptAggregate:
+    """Aggregates of all the iterations of one script under one condition, maintained in O(1) per iteration."""
+
+    def __init__(self) -> None:
+        self.n_observations = 0
+        self.signatures = set[tuple[int, str, str]]()
+        self.execution_class = ExecutionClass.unknown
+
+    @property
+    def deterministic(self) -> bool:
+        return len(self.signatures) == 1
+
+    def add(self, script_result: ScriptResult) -> None:
+        self.n_observations += 1
+        self.signatures.add(result_signature(script_result))
+        self.execution_class = best_execution_class([self.execution_class, script_result.execution_class])
+
+
+class ResultTables:
+    """Accumulates results into columns, updating the per-script aggregates as each result comes in.
+
+    This avoids re-concatenating DataFrames and re-running groupby for every new result.
+    Use aggregate_scripts to recompute the aggregates from scratch.
+
+    """
+
+    doi_columns = ("idx", "code", "r_version", "code_cleaning", "result", "experimental_status")
+    script_columns = ("doi_idx", "code", "r_version", "code_cleaning", "script", "result", "execution_class", "signature_hash")
+    script_agg_iterations_index = ("r_version", "code_cleaning", "code", "script")
+    script_agg_r_version_index = ("code_cleaning", "code", "script")
+
+    def __init__(self) -> None:
+        self.doi_data: dict[str, list[Any]] = {column: [] for column in self.doi_columns}
+        self.script_data: dict[str, list[Any]] = {column: [] for column in self.script_columns}
+        self.script_agg_iterations: dict[tuple[str, CodeCleaning, Code, str], ScriptAggregate] = {}
+        self.script_agg_r_version: dict[tuple[CodeCleaning, Code, str], ExecutionClass] = {}
+        self.lock = threading.Lock()
+
+    def append(
+            self,
+            idx: int,
+            code: WorkflowCode,
+            condition: TrisovicCondition,
+            result: MyReducedResult | Exception,
+    ) -> None:
+        with self.lock:
+            self._append(idx, code, condition, result)
+
+    def _append(
+            self,
+            idx: int,
+            code: WorkflowCode,
+            condition: TrisovicCondition,
+            result: MyReducedResult | Exception,
+    ) -> None:
+        for column, value in zip(self.doi_columns, (
+                idx,
+                code.code,
+                condition.r_version,
+                condition.code_cleaning,
+                result,
+                get_experimental_status(result),
+        )):
+            self.doi_data[column].append(value)
+        if isinstance(result, MyReducedResult):
+            for script_name, script_result in result.script_results.items():
+                for column, script_value in zip(self.script_columns, (
+                        idx,
+                        code.code,
+                        condition.r_version,
+                        condition.code_cleaning,
+                        script_name,
+                        script_result,
+                        script_result.execution_class,
+                        hash(result_signature(script_result)),
+                )):
+                    self.script_data[column].append(script_value)
+                key = (condition.r_version, condition.code_cleaning, code.code, script_name)
+                self.script_agg_iterations.setdefault(key, ScriptAggregate()).add(script_result)
+                key2 = (condition.code_cleaning, code.code, script_name)
+                self.script_agg_r_version[key2] = best_execution_class([
+                    self.script_agg_r_version.get(key2, ExecutionClass.unknown),
+                    script_result.execution_class,
+                ])
+
+    def doi_df(self) -> pandas.DataFrame:
+        return self._doi_df(self.doi_data)
+
+    def script_df(self) -> pandas.DataFrame:
+        return self._script_df(self.script_data)
+
+    def script_aggregates(self) -> tuple[pandas.DataFrame, pandas.DataFrame]:
+        return self._script_aggregates(self._script_agg_iterations_rows(), list(self.script_agg_r_version.items()))
+
+    def snapshot(self) -> tuple[pandas.DataFrame, pandas.DataFrame, pandas.DataFrame, pandas.DataFrame]:
+        """Returns doi_df, script_df, and the script aggregates, consistent with each other, even while another thread appends.
+
+        Only copying the columns holds the lock; building the DataFrames does not, so append doesn't wait on it.
+
+        """
+        with self.lock:
+            doi_data = {column: list(values) for column, values in self.doi_data.items()}
+            script_data = {column: list(values) for column, values in self.script_data.items()}
+            script_agg_iterations_rows = self._script_agg_iterations_rows()
+            script_agg_r_version_rows = list(self.script_agg_r_version.items())
+        return (
+            self._doi_df(doi_data),
+            self._script_df(script_data),
+            *self._script_aggregates(script_agg_iterations_rows, script_agg_r_version_rows),
+        )
+
+    def _script_agg_iterations_rows(self) -> list[tuple[tuple[str, CodeCleaning, Code, str], int, bool, ExecutionClass]]:
+        # ScriptAggregates change in place, so this copies their current values.
+        return [
+            (key, agg.n_observations, agg.deterministic, agg.execution_class)
+            for key, agg in self.script_agg_iterations.items()
+        ]
+
+    @classmethod
+    def _doi_df(cls, doi_data: Mapping[str, list[Any]]) -> pandas.DataFrame:
+        return pandas.DataFrame(doi_data, columns=cls.doi_columns)
+
+    @classmethod
+    def _script_df(cls, script_data: Mapping[str, list[Any]]) -> pandas.DataFrame:
+        return pandas.DataFrame(
+            {
+                **script_data,
+                "execution_class": execution_class_categorical(script_data["execution_class"]),
+            },
+            columns=cls.script_columns,
+        )
+
+    @classmethod
+    def _script_aggregates(
+            cls,
+            script_agg_iterations_rows: Sequence[tuple[tuple[str, CodeCleaning, Code, str], int, bool, ExecutionClass]],
+            script_agg_r_version_rows: Sequence[tuple[tuple[CodeCleaning, Code, str], ExecutionClass]],
+    ) -> tuple[pandas.DataFrame, pandas.DataFrame]:
+        script_agg_iterations_df = pandas.DataFrame(
+            {
+                "n_observations": [n_observations for _, n_observations, _, _ in script_agg_iterations_rows],
+                "deterministic": [deterministic for _, _, deterministic, _ in script_agg_iterations_rows],
+                "execution_class": execution_class_categorical(execution_class for _, _, _, execution_class in script_agg_iterations_rows),
+            },
+            index=pandas.MultiIndex.from_tuples(
+                [key for key, _, _, _ in script_agg_iterations_rows],
+                names=cls.script_agg_iterations_index,
+            ),
+        )
+        script_agg_r_version_df = pandas.DataFrame(
+            {
+                "execution_class": execution_class_categorical(execution_class for _, execution_class in script_agg_r_version_rows),
+            },
+            index=pandas.MultiIndex.from_tuples(
+                [key for key, _ in script_agg_r_version_rows],
+                names=cls.script_agg_r_version_index,
+            ),
+        )
+        return script_agg_iterations_df, script_agg_r_version_df
+
+
+def aggregate_scripts(
+        script_df: pandas.DataFrame,
+) -> tuple[pandas.DataFrame, pandas.DataFrame]:
+    """Compute the per-script aggregates from scratch; see ResultTables for the incremental version.
+
+    script_df should come from ResultTables.script_df, which precomputes signature_hash and a categorical execution_class.
+
+    """
+    script_agg_iterations_df = (
+        script_df
+        .assign(execution_class_code=script_df["execution_class"].cat.codes)
+        .groupby(list(ResultTables.script_agg_iterations_index), sort=False)
+        .agg(
+            n_observations=("signature_hash", "size"),
+            n_signatures=("signature_hash", "nunique"),
+            execution_class_code=("execution_class_code", "min"),
+        )
+    )
+    script_agg_iterations_df["deterministic"] = script_agg_iterations_df.pop("n_signatures") == 1
+    script_agg_iterations_df["execution_class"] = pandas.Categorical.from_codes(
+        script_agg_iterations_df["execution_class_code"],
+        dtype=script_df["execution_class"].dtype,
+    )
+
+    script_agg_r_version_df = (
+        script_agg_iterations_df
+        .groupby(list(ResultTables.script_agg_r_version_index), sort=False)  # NOT r_version
+        .agg(execution_class_code=("execution_class_code", "min"))
+    )
+    script_agg_r_version_df["execution_class"] = pandas.Categorical.from_codes(
+        script_agg_r_version_df.pop("execution_class_code"),
+        dtype=script_df["execution_class"].dtype,
+    )
+    del script_agg_iterations_df["execution_class_code"]
+    return script_agg_iterations_df, script_agg_r_version_df
+
+
 def status_update(
         experimental_config: Config,
         doi_df: pandas.DataFrame,
         script_df: pandas.DataFrame,
+        script_agg_iterations_df: pandas.DataFrame,
+        script_agg_r_version_df: pandas.DataFrame,
         complete: bool,
 ) -> None:
     print("#" * 80)
     print(f"{len(doi_df)} dois, {len(script_df)} scripts")
 
-    doi_df["experimental_status"] = doi_df.result.map(get_experimental_status)
     normal_mask = doi_df.experimental_status == "normal"
     if not all(normal_mask):
         print(
@@ -477,71 +726,22 @@ def status_update(
             print(row["code"], "exception:")
             print(traceback.print_exception(row["result"], file=sys.stderr))
 
-    script_df["execution_class"] = script_df["result"].map(lambda obj: obj.execution_class)
     print(
         "execution_class",
         list(script_df["execution_class"].value_counts().items()),
     )
 
-    script_agg_iterations_df = pandas.DataFrame()
-    script_agg_iterations_df["n_observations"] = [] if script_df.empty else (
-        script_df
-        .groupby(["r_version", "code_cleaning", "code", "script"], sort=False)
-        .apply(lambda group: len(group))
-    )
-
     script_agg_iterations_df["complete"] = script_agg_iterations_df.n_observations == experimental_config.n_repetitions
     if complete and not all(script_agg_iterations_df.complete):
         incompletes = script_agg_iterations_df[~script_agg_iterations_df.complete]
         for index, _ in incompletes.iterrows():
             print(index, "have only", script_agg_iterations_df.loc[index, "n_observations"], "observations!")
 
-    script_agg_iterations_df["deterministic"] = [] if script_df.empty else (
-        script_df
-        .groupby(["r_version", "code_cleaning", "code", "script"], sort=False)
-        .apply(
-            lambda group:
-            (
-                group["result"]
-                .apply(lambda result: (
-                    result.exit_code,
-                    "\n".join(result.stdout.split("\n")[-5:]),
-                    "\n".join(result.stderr.split("\n")[-5:]),
-                ))
-                .nunique()
-            ) == 1
-        )
-    )
     print(
         "deterministim?",
         list(script_agg_iterations_df["deterministic"].value_counts().items()),
     )
 
-    script_agg_iterations_df["execution_class"] = [] if script_df.empty else (
-        script_df
-        .groupby(["r_version", "code_cleaning", "code", "script"], sort=False)
-        .apply(
-            lambda condition_code_script_df:
-            ExecutionClass.success if (condition_code_script_df["execution_class"] == ExecutionClass.success).any() else
-            ExecutionClass.timed_out if (condition_code_script_df["execution_class"] == ExecutionClass.timed_out).any() else
-            ExecutionClass.failure if (condition_code_script_df["execution_class"] == ExecutionClass.failure).any() else
-            ExecutionClass.unknown
-        )
-    )
-
-    script_agg_r_version_df = pandas.DataFrame()
-    script_agg_r_version_df["execution_class"] = [] if script_agg_iterations_df.empty else (
-        script_agg_iterations_df
-        .reset_index()
-        .groupby(["code_cleaning", "code", "script"], sort=False)  # NOT r_version
-        .apply(
-            lambda condition_code_script_df:
-            ExecutionClass.success if (condition_code_script_df["execution_class"] == ExecutionClass.success).any() else
-            ExecutionClass.timed_out if (condition_code_script_df["execution_class"] == ExecutionClass.timed_out).any() else
-            ExecutionClass.failure if (condition_code_script_df["execution_class"] == ExecutionClass.failure).any() else
-            ExecutionClass.unknown
-        )
-    )
     print(overall_classification_table(script_agg_r_version_df))
 
     latest_r_version = max(script_df["r_version"])
@@ -581,10 +781,156 @@ def status_update(
                     if val is not None:
                         ret.append(f"      {key}: {val}")
         ret.append("")
-    pathlib.Path("errors.yaml").write_text("\n".join(ret))
+    atomic_write_text(pathlib.Path("errors.yaml"), "\n".join(ret))
+
+
+class StatusReporter:
+    """Calls status_update in a background thread, so the caller never waits on report generation.
+
+    Reports every refresh_interval, or sooner if refresh_every new results have come in.
+
+    """
+
+    def __init__(
+            self,
+            experimental_config: Config,
+            result_tables: ResultTables,
+            refresh_interval: datetime.timedelta = datetime.timedelta(seconds=30),
+            refresh_every: Optional[int] = None,
+    ) -> None:
+        self.experimental_config = experimental_config
+        self.result_tables = result_tables
+        self.refresh_interval = refresh_interval
+        self.refresh_every = refresh_every
+        # result_added (on the caller's thread) and _loop (on the reporter's thread) both update _n_new_results.
+        self._lock = threading.Lock()
+        self._n_new_results = 0
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop, name="status-reporter", daemon=True)
+
+    def __enter__(self) -> StatusReporter:
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self._stopped = True
+        self._wake.set()
+        self._thread.join()
+
+    def result_added(self) -> None:
+        with self._lock:
+            self._n_new_results += 1
+            n_new_results = self._n_new_results
+        if self.refresh_every is not None and n_new_results >= self.refresh_every:
+            self._wake.set()
+
+    def _loop(self) -> None:
+        while not self._stopped:
+            self._wake.wait(timeout=self.refresh_interval.total_seconds())
+            self._wake.clear()
+            with self._lock:
+                n_new_results = self._n_new_results
+                self._n_new_results = 0
+            if n_new_results and not self._stopped:
+                try:
+                    status_update(self.experimental_config, *self.result_tables.snapshot(), complete=False)
+                except Exception as exc:
+                    traceback.print_exception(exc, file=sys.stderr)
+
+
+def script_procs(result: MyReducedResult) -> Mapping[str, CompletedContainer]:
+    """Maps each script to the last container that ran it.
+
+    RLangExecutor runs scripts as `env --chdir $code_dir ... Rscript $code_dir/$script`.
+
+    """
+    return {
+        str(pathlib.Path(proc.command[-1]).relative_to(proc.command[2])): proc
+        for proc in result.workflow_execution.procs
+        if proc.command[:2] == ("env", "--chdir") and proc.command[-2] == "Rscript" and pathlib.Path(proc.command[-1]).is_absolute()
+    }
+
+
+class ParquetResultSink:
+    """Writes one row per script execution to a Parquet dataset, partitioned by condition, as results come in.
+
+    Downstream analyses can read only the columns they need (see read_parquet_results) rather than unpickling every MyReducedResult.
+    The dataset at path is replaced, since every run streams every result anyway.
+    Requires pandas' Parquet engine (pyarrow).
+
+    """
+
+    partition_columns = ["r_version", "code_cleaning"]
+
+    def __init__(self, path: pathlib.Path, flush_every: int = 256) -> None:
+        # Fail now, rather than at the first flush, partway through a run.
+        try:
+            import pyarrow  # type: ignore
+        except ImportError as exc:
+            raise ImportError("ParquetResultSink requires pyarrow, which is not installed") from exc
+        self.path = path
+        self.flush_every = flush_every
+        self._rows: list[Mapping[str, Any]] = []
+
+    def __enter__(self) -> ParquetResultSink:
+        if self.path.exists():
+            shutil.rmtree(self.path)
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.flush()
+
+    def append(
+            self,
+            code: WorkflowCode,
+            condition: TrisovicCondition,
+            iteration: int,
+            result: MyReducedResult | Exception,
+    ) -> None:
+        if isinstance(result, MyReducedResult):
+            procs = script_procs(result)
+            for script_name, script_result in result.script_results.items():
+                proc = procs.get(script_name, None)
+                self._rows.append({
+                    "code": expect_type(DataverseDataset, code.code).persistent_id,
+                    "r_version": condition.r_version,
+                    "code_cleaning": condition.code_cleaning.value,
+                    "iteration": iteration,
+                    "script": script_name,
+                    "exit_code": script_result.exit_code,
+                    "execution_class": script_result.execution_class.value,
+                    "wall_time": proc.resource.wall_time.total_seconds() if proc is not None else None,
+                    "max_rss": proc.resource.max_resident_set_size if proc is not None else None,
+                    "event_kinds": [event.kind for event in script_result.events],
+                })
+            if len(self._rows) >= self.flush_every:
+                self.flush()
+
+    def flush(self) -> None:
+        if self._rows:
+            pandas.DataFrame.from_records(self._rows).to_parquet(
+                self.path,
+                partition_cols=self.partition_columns,
+                index=False,
+            )
+            self._rows = []
+
 
+def read_parquet_results(
+        path: pathlib.Path,
+        columns: Optional[Sequence[str]] = None,
+        filters: Optional[Sequence[tuple[str, str, Any]]] = None,
+) -> pandas.DataFrame:
+    """Reads the dataset written by ParquetResultSink, e.g. `filters=[("code_cleaning", "==", "none")]`."""
+    return pandas.read_parquet(path, columns=columns, filters=filters)
 
-def run() -> None:
+
+def run(
+        refresh_interval: datetime.timedelta = datetime.timedelta(seconds=30),
+        refresh_every: Optional[int] = None,
+        parquet_path: Optional[pathlib.Path] = None,
+) -> None:
     dask_client = config.dask_client()
     execute_workflow = ExecuteWorkflow()
     my_reduction = MyReduction()
@@ -619,6 +965,7 @@ def run() -> None:
         dask_client,
         experimental_config,
         randomize_dispatch_order=True,
+        max_in_flight=1024,
     )
     all_results = tqdm.tqdm(
         results_stream,
@@ -627,66 +974,45 @@ def run() -> None:
     )
     # all_results = get_results(experimental_config)
 
-    doi_df = pandas.DataFrame(columns=["code", "r_version", "code_cleaning", "result"])
-    script_df = pandas.DataFrame(columns=["code", "r_version", "code_cleaning", "script", "result"])
+    result_tables = ResultTables()
 
     cleared = 0  # DEBUG
-    for n, (code, condition, detailed_result_or_exc) in enumerate(all_results):
-        code = expect_type(WorkflowCode, code)
-        condition = expect_type(TrisovicCondition, condition)
-        doi_df = pandas.concat([
-            doi_df,
-            pandas.DataFrame.from_records(
-                [
-                    {
-                        "idx": n,
-                        "code": code.code,
-                        "r_version": condition.r_version,
-                        "code_cleaning": condition.code_cleaning,
-                        "result": detailed_result_or_exc,
-                    }
-                ],
-            ),
-        ])
-        # DEBUG
-        if any(
-                any([
-                    b"CMake was not found" in proc.stderr_b,
-                    b"charmonium_state.R" in proc.stderr_b,
-                    b"cannot find nlopt" in proc.stderr_b,
-                    b"awk: command not found" in proc.stderr_b,
-                    condition.code_cleaning == CodeCleaning.grayson,
-                ])
-                for proc in detailed_result_or_exc.workflow_execution.procs
-        ):
-            clear_cache(reduced_analysis, my_reduction, execute_workflow, code, condition, 0)
-            clear_cache(analyze, execute_workflow, code, condition, 0)
-            cleared += 1
-        print("=====\ncleared:", cleared)  # DEBUG
-        if isinstance(detailed_result_or_exc, MyReducedResult):
-            script_df = pandas.concat([
-                script_df,
-                pandas.DataFrame.from_records(
-                    [
-                        {
-                            "doi_idx": n,
-                            "code": expect_type(WorkflowCode, code).code,
-                            "r_version": condition.r_version,
-                            "code_cleaning": condition.code_cleaning,
-                            "script": script_name,
-                            "result": script_result,
-                        }
-                        for script_name, script_result in detailed_result_or_exc.script_results.items()
-                    ],
-                ),
-            ])
-        try:
-            status_update(experimental_config, doi_df, script_df, False)
-        except Exception as exc:
-            traceback.print_exception(exc, file=sys.stderr)
-
+    with contextlib.ExitStack() as exit_stack:
+        status_reporter = exit_stack.enter_context(StatusReporter(experimental_config, result_tables, refresh_interval, refresh_every))
+        parquet_sink: Optional[ParquetResultSink] = (
+            exit_stack.enter_context(ParquetResultSink(parquet_path))
+            if parquet_path is not None
+            else None
+        )
+        for n, (code, condition, iteration, detailed_result_or_exc) in enumerate(all_results):
+            code = expect_type(WorkflowCode, code)
+            condition = expect_type(TrisovicCondition, condition)
+            if not isinstance(detailed_result_or_exc, Exception):
+                detailed_result_or_exc = expect_type(MyReducedResult, detailed_result_or_exc)
+            result_tables.append(n, code, condition, detailed_result_or_exc)
+            if parquet_sink is not None:
+                parquet_sink.append(code, condition, iteration, detailed_result_or_exc)
+            status_reporter.result_added()
+            # DEBUG
+            if any(
+                    any([
+                        b"CMake was not found" in proc.stderr_b,
+                        b"charmonium_state.R" in proc.stderr_b,
+                        b"cannot find nlopt" in proc.stderr_b,
+                        b"awk: command not found" in proc.stderr_b,
+                        condition.code_cleaning == CodeCleaning.grayson,
+                    ])
+                    for proc in detailed_result_or_exc.workflow_execution.procs
+            ):
+                clear_cache(reduced_analysis, my_reduction, execute_workflow, code, condition, 0)
+                clear_cache(analyze, execute_workflow, code, condition, 0)
+                cleared += 1
+            print("=====\ncleared:", cleared)  # DEBUG
+
+    doi_df = result_tables.doi_df()
+    script_df = result_tables.script_df()
     try:
-        status_update(experimental_config, doi_df, script_df, True)
+        status_update(experimental_config, doi_df, script_df, *aggregate_scripts(script_df), complete=True)
     except Exception as exc:
         traceback.print_exception(exc, file=sys.stderr)
     import IPython; IPython.embed()  # type: ignore
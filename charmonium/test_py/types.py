@@ -2,7 +2,69 @@ from __future__ import annotations
 import abc
 import dataclasses
 import pathlib
-from typing import Iterable, Mapping, Optional
+from typing import Any, Hashable, Iterable, Mapping, Optional
+
+import charmonium.freeze
+
+
+class Fingerprinted:
+    """Mixin for objects that freeze (for cache keys) by a fingerprint, which is computed once and cached on the instance.
+
+    Otherwise, charmonium.freeze walks the object and its whole class on every memoized call.
+    The fingerprint combines the frozen class (computed once per process, as charmonium.freeze assumes classes don't change)
+    with the frozen fingerprint_state, which defaults to the instance's attributes.
+    Instances must not change after they are first frozen.
+
+    """
+
+    def fingerprint_state(self) -> Hashable:
+        return tuple(sorted(
+            (key, val)
+            for key, val in vars(self).items()
+            if key != "_fingerprint"
+        ))
+
+    def __getstate__(self) -> Mapping[str, Any]:
+        # Don't pickle the fingerprint, lest an instance unpickled by newer code (e.g., from an old cache entry) carry a stale one.
+        return {
+            key: val
+            for key, val in vars(self).items()
+            if key != "_fingerprint"
+        }
+
+
+_class_fingerprints: dict[tuple[int, type], Hashable] = {}
+
+
+@charmonium.freeze.lib.freeze_dispatch.register(Fingerprinted)
+def _(
+        obj: Fingerprinted,
+        config: charmonium.freeze.Config,
+        tabu: dict[int, tuple[int, int]],
+        depth: int,
+        index: int,
+) -> tuple[Hashable, bool, Optional[int]]:
+    if not config.use_hash:
+        # Without hashing (e.g., when summarizing diffs), the caller wants the structure, not an opaque fingerprint.
+        return charmonium.freeze.lib.freeze_sequence(
+            (type(obj), obj.fingerprint_state()),
+            is_immutable=True,
+            order_matters=True,
+            config=config,
+            tabu=tabu,
+            depth=depth,
+        )
+    # Fingerprints are only comparable under the same config.
+    cached = vars(obj).get("_fingerprint")
+    if cached is None or cached[0] != id(config):
+        class_key = (id(config), type(obj))
+        if class_key not in _class_fingerprints:
+            _class_fingerprints[class_key] = charmonium.freeze.freeze(type(obj), config)
+        fingerprint = charmonium.freeze.freeze((_class_fingerprints[class_key], obj.fingerprint_state()), config)
+        # object.__setattr__ works even on frozen dataclasses.
+        object.__setattr__(obj, "_fingerprint", (id(config), fingerprint))
+        cached = vars(obj)["_fingerprint"]
+    return cached[1], True, None
 
 
 class Registry(abc.ABC):
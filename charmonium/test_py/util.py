@@ -1,19 +1,30 @@
 import types
 import tempfile
+import concurrent.futures
 import contextlib
+import dataclasses
 import itertools
 import datetime
+import collections
+import functools
+import mmap
 import docker  # type: ignore
+import fcntl
 import os
 import random
 import pathlib
+import queue
 import string
 import shutil
 import shlex
+import stat
 import urllib.parse
 import subprocess
+import threading
+import time
+import warnings
 import xml.etree.ElementTree
-from typing import Generator, Iterable, TypeVar, Any, Mapping, TypeGuard, TYPE_CHECKING, cast
+from typing import IO, Callable, Generator, Iterable, TypeVar, Any, Mapping, Sequence, TypeGuard, TYPE_CHECKING, cast
 
 
 def fs_escape(string: str) -> str:
@@ -46,17 +57,238 @@ elif not tempfile.gettempdir().startswith("/tmp"):
 else:
     tmp_root = pathlib.Path.home() / "tmp"
 
+def fsync_dir(path: pathlib.Path) -> None:
+    """Make the entries of directory path durable, without flushing the rest of the filesystem like os.sync() does."""
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _owner_of(name: str) -> str | None:
+    """The owner of a name made by Reaper.owned_name, or None if name was not made that way."""
+    owner, sep, rest = name.partition("-")
+    if sep and len(owner) == len(rest) == 10 and (owner + rest).isalpha() and (owner + rest).islower():
+        return owner
+    else:
+        return None
+
+
+class Reaper:
+    """Deletes directories in a background thread, so callers don't wait for large trees to be deleted.
+
+    A directory is renamed into trash (which should be on the same filesystem) right away,
+    and then deleted at no more than max_files_per_second, so the deletion doesn't starve running jobs of I/O.
+    If more than max_pending directories are waiting, the caller deletes the directory itself, so a backlog can't fill the disk.
+
+    Each process that uses the reaper holds a lock in trash for as long as it lives.
+    Trees in trash or in orphan_roots, named by owned_name, whose owner's lock is not held were left by a crashed process;
+    the reaper deletes those when it starts.
+
+    """
+
+    def __init__(
+            self,
+            trash: pathlib.Path,
+            orphan_roots: Sequence[pathlib.Path] = (),
+            max_pending: int = 16,
+            max_files_per_second: int = 10000,
+    ) -> None:
+        self.trash = trash
+        self.orphan_roots = orphan_roots
+        self.max_pending = max_pending
+        self.max_files_per_second = max_files_per_second
+        self._lock = threading.Lock()
+        self._pid: int | None = None
+        self._owner = ""
+        self._lock_fd = -1
+        self._queue: queue.Queue[pathlib.Path] = queue.Queue(maxsize=max_pending)
+
+    def _start(self) -> None:
+        if self._pid == os.getpid():
+            return
+        if self._pid is not None:
+            # A forked child gets neither the thread nor a lock in trash of its own, so it starts over.
+            self._lock = threading.Lock()
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            (self.trash / ".locks").mkdir(parents=True, exist_ok=True)
+            while True:
+                owner = random_str(10)
+                try:
+                    lock_fd = os.open(self.trash / ".locks" / owner, os.O_RDWR | os.O_CREAT | os.O_EXCL)
+                except FileExistsError:
+                    continue
+                else:
+                    break
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            self._owner = owner
+            self._lock_fd = lock_fd
+            self._queue = queue.Queue(maxsize=self.max_pending)
+            threading.Thread(target=self._run, args=(self._queue,), daemon=True).start()
+            self._pid = os.getpid()
+
+    def owned_name(self) -> str:
+        """A fresh name that marks its bearer as belonging to this process."""
+        self._start()
+        return f"{self._owner}-{random_str(10)}"
+
+    def delete(self, path: pathlib.Path) -> None:
+        self._start()
+        trash_path = self.trash / self.owned_name()
+        try:
+            os.rename(path, trash_path)
+        except OSError:
+            # E.g., path is not on the same filesystem as trash.
+            shutil.rmtree(path)
+            return
+        try:
+            self._queue.put_nowait(trash_path)
+        except queue.Full:
+            self._rmtree(trash_path, throttled=False)
+
+    def join(self) -> None:
+        """Wait for the directories passed to delete so far to be deleted."""
+        self._start()
+        self._queue.join()
+
+    def _run(self, pending: queue.Queue[pathlib.Path]) -> None:
+        self._reap_orphans()
+        while True:
+            path = pending.get()
+            self._rmtree(path, throttled=True)
+            pending.task_done()
+
+    def _is_alive(self, owner: str) -> bool:
+        try:
+            lock_fd = os.open(self.trash / ".locks" / owner, os.O_RDWR)
+        except FileNotFoundError:
+            return False
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        else:
+            # Nobody holds the lock anymore, so nobody will use it.
+            (self.trash / ".locks" / owner).unlink(missing_ok=True)
+            return False
+        finally:
+            os.close(lock_fd)
+
+    def _reap_orphans(self) -> None:
+        dead_owners: set[str] = set()
+        for root in [self.trash, *self.orphan_roots]:
+            if not root.exists():
+                continue
+            for entry in os.scandir(root):
+                owner = _owner_of(entry.name)
+                if owner is None or owner == self._owner:
+                    continue
+                if owner not in dead_owners:
+                    if self._is_alive(owner):
+                        continue
+                    dead_owners.add(owner)
+                # Renaming claims the tree, in case another process is reaping orphans too.
+                trash_path = self.trash / f"{self._owner}-{random_str(10)}"
+                try:
+                    os.rename(entry.path, trash_path)
+                except FileNotFoundError:
+                    continue
+                self._rmtree(trash_path, throttled=True)
+
+    def _rmtree(self, path: pathlib.Path, throttled: bool) -> None:
+        start = time.monotonic()
+        n_deleted = 0
+        try:
+            for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+                for name in filenames:
+                    os.unlink(os.path.join(dirpath, name))
+                for name in dirnames:
+                    # os.walk lists symlinks to directories as directories.
+                    if os.path.islink(os.path.join(dirpath, name)):
+                        os.unlink(os.path.join(dirpath, name))
+                    else:
+                        os.rmdir(os.path.join(dirpath, name))
+                n_deleted += len(filenames) + len(dirnames)
+                if throttled:
+                    time.sleep(max(0, n_deleted / self.max_files_per_second - (time.monotonic() - start)))
+            os.rmdir(path)
+        except OSError as exc:
+            warnings.warn(f"Could not delete {path}: {exc}")
+
+
+class TempDirPool:
+    """Empty directories in root, created ahead of time in batches.
+
+    Creating a batch costs one fsync of root, rather than one per directory.
+    Directories which are empty when they are returned get reused; the rest get deleted by reaper.
+
+    """
+
+    def __init__(self, root: pathlib.Path, reaper: Reaper, batch_size: int = 8) -> None:
+        self.root = root
+        self.reaper = reaper
+        self.batch_size = batch_size
+        self._free: list[pathlib.Path] = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _check_fork(self) -> None:
+        # A forked child must not hand out the same directories as its parent.
+        if self._pid != os.getpid():
+            self._free = []
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+
+    def _make(self) -> pathlib.Path:
+        # random_str may return the same names in forked processes, so mkdir (atomically) claims the name.
+        while True:
+            path = self.root / self.reaper.owned_name()
+            try:
+                path.mkdir()
+            except FileExistsError:
+                continue
+            else:
+                return path
+
+    def get(self) -> pathlib.Path:
+        self._check_fork()
+        with self._lock:
+            if not self._free:
+                self.root.mkdir(parents=True, exist_ok=True)
+                self._free = [self._make() for _ in range(self.batch_size)]
+                fsync_dir(self.root)
+            return self._free.pop()
+
+    def put(self, path: pathlib.Path) -> None:
+        """Return path, whose contents will be deleted."""
+        with os.scandir(path) as entries:
+            is_empty = next(entries, None) is None
+        if is_empty:
+            self._check_fork()
+            with self._lock:
+                if len(self._free) < self.batch_size:
+                    self._free.append(path)
+                    return
+        self.reaper.delete(path)
+
+
+# tmp_root is shared with other programs, so everything we create (and reap) stays in our own subdirectory.
+temp_dir_root = tmp_root / "charmonium-test-py"
+reaper = Reaper(temp_dir_root / ".trash", orphan_roots=(temp_dir_root,))
+temp_dir_pool = TempDirPool(temp_dir_root, reaper)
+
+
 @contextlib.contextmanager
 def create_temp_dir(cleanup: bool = True) -> Generator[pathlib.Path, None, None]:
-    temp_dir = get_unused_path(tmp_root, (random_str(10) for _ in itertools.count()))
-    temp_dir.mkdir(parents=True)
-    os.sync()
+    temp_dir = temp_dir_pool.get()
     try:
         yield pathlib.Path(temp_dir)
     finally:
         if cleanup:
-            shutil.rmtree(temp_dir)
-            os.sync()
+            temp_dir_pool.put(temp_dir)
 
 
 _T = TypeVar("_T")
@@ -68,23 +300,97 @@ def flatten1(elemss: Iterable[Iterable[_T]]) -> Iterable[_T]:
             yield elem
 
 
+@dataclasses.dataclass(frozen=True)
+class FileEntry:
+    """A non-directory found by scan_files.
+
+    Like pathlib, is_file and the stat info follow symlinks; a broken symlink is not a file, and has the stat info of the link.
+
+    Since ctime cannot be set by the user, it tells when a file was last changed, even if its mtime was preserved (e.g., by unzip).
+
+    """
+    path: pathlib.Path
+    is_file: bool
+    is_symlink: bool
+    size: int
+    mtime: datetime.datetime
+    ctime: datetime.datetime
+    inode: int
+
+
+def _scan_dir(path: pathlib.Path) -> tuple[list[FileEntry], list[pathlib.Path]]:
+    entries: list[FileEntry] = []
+    subdirs: list[pathlib.Path] = []
+    with os.scandir(path) as dir_entries:
+        for dir_entry in dir_entries:
+            # Don't follow symlinks to directories, lest we loop forever.
+            if dir_entry.is_dir(follow_symlinks=False):
+                subdirs.append(path / dir_entry.name)
+            else:
+                try:
+                    stat = dir_entry.stat()
+                    is_file = dir_entry.is_file()
+                except FileNotFoundError:
+                    stat = dir_entry.stat(follow_symlinks=False)
+                    is_file = False
+                entries.append(FileEntry(
+                    path=path / dir_entry.name,
+                    is_file=is_file,
+                    is_symlink=dir_entry.is_symlink(),
+                    size=stat.st_size,
+                    mtime=datetime.datetime.fromtimestamp(stat.st_mtime),
+                    ctime=datetime.datetime.fromtimestamp(stat.st_ctime),
+                    inode=stat.st_ino,
+                ))
+    return entries, subdirs
+
+
+def scan_files(path: pathlib.Path, full_path: bool = True, parallelism: int = 8) -> Iterable[FileEntry]:
+    """Yield every non-directory under path, with its stat info, statting each one just once.
+
+    Subdirectories are scanned in parallel, and entries are yielded as their directory finishes (in no particular order).
+
+    """
+    if not path.is_dir():
+        stat = path.stat() if path.exists() else path.lstat()
+        yield FileEntry(
+            path=path if full_path else path.relative_to(path),
+            is_file=path.is_file(),
+            is_symlink=path.is_symlink(),
+            size=stat.st_size,
+            mtime=datetime.datetime.fromtimestamp(stat.st_mtime),
+            ctime=datetime.datetime.fromtimestamp(stat.st_ctime),
+            inode=stat.st_ino,
+        )
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallelism) as executor:
+        pending = {executor.submit(_scan_dir, path)}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                entries, subdirs = future.result()
+                pending |= {executor.submit(_scan_dir, subdir) for subdir in subdirs}
+                for entry in entries:
+                    yield entry if full_path else dataclasses.replace(entry, path=entry.path.relative_to(path))
+
+
 def walk_files(path: pathlib.Path, full_path: bool = True) -> Iterable[pathlib.Path]:
-    yield from _walk_files(path, path, full_path)
+    for entry in scan_files(path, full_path):
+        yield entry.path
 
 
-def _walk_files(
-    path: pathlib.Path,
-    root_path: pathlib.Path,
-    full_path: bool,
-) -> Iterable[pathlib.Path]:
-    if path.is_dir():
-        for subpath in path.iterdir():
-            yield from _walk_files(subpath, root_path, full_path)
-    else:
-        if full_path:
-            yield path
-        else:
-            yield path.relative_to(root_path)
+def atomic_write_text(path: pathlib.Path, text: str) -> None:
+    """Write text to path such that readers see either the old contents or the new contents, never a partial write."""
+    tmp_path = path.parent / f".{path.name}.{random_str(10)}.tmp"
+    tmp_path.write_text(text)
+    os.replace(tmp_path, path)
+
+
+def atomic_write_bytes(path: pathlib.Path, data: bytes) -> None:
+    """Like atomic_write_text, but for bytes."""
+    tmp_path = path.parent / f".{path.name}.{random_str(10)}.tmp"
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
 
 
 def mtime(path: pathlib.Path) -> datetime.datetime:
@@ -99,21 +405,105 @@ def mime_type(path: pathlib.Path) -> str:
     return subprocess.run(["file", "--brief", "--mime-type", str(path)], capture_output=True, text=True, check=True).stdout.strip()
 
 
-def hash_path(path: pathlib.Path | str | bytes, size: int = 128) -> int:
+def file_types(paths: Sequence[pathlib.Path], mime: bool = False) -> list[str]:
+    """Like `[file_type(path) for path in paths]` (or mime_type, if mime), but in one `file` process."""
+    # --files-from is newline-delimited, so paths with newlines get their own process.
+    batchable = ["\n" not in str(path) for path in paths]
+    output = subprocess.run(
+        ["file", "--brief", *(["--mime-type"] if mime else []), "--files-from", "-"],
+        input="".join(f"{path}\n" for path, ok in zip(paths, batchable) if ok),
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    lines = iter(output.split("\n"))
+    single_file_type = mime_type if mime else file_type
+    return [
+        next(lines).strip() if ok else single_file_type(path)
+        for path, ok in zip(paths, batchable)
+    ]
+
+
+@functools.cache
+def _hasher_constructor(size: int) -> Callable[..., Any]:
     import xxhash
-    hasher = {
-        128: xxhash.xxh128(),
-        64: xxhash.xxh64(),
-        32: xxhash.xxh32(),
-    }[size]
-    block_size = 1 << 14
+    return cast(Callable[..., Any], {
+        128: xxhash.xxh128,
+        64: xxhash.xxh64,
+        32: xxhash.xxh32,
+    }[size])
+
+
+class _HashCache:
+    """Bounded map from (dev, inode, size, mtime, ctime, hash size) of a file to its hash."""
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._entries: collections.OrderedDict[tuple[int, ...], int] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple[int, ...]) -> int | None:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            else:
+                return None
+
+    def put(self, key: tuple[int, ...], hash_val: int) -> None:
+        with self._lock:
+            self._entries[key] = hash_val
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+_hash_cache = _HashCache(1 << 16)
+_mmap_threshold = 1 << 20
+_block_size = 1 << 20
+
+
+def _hash_cache_key(stat_result: os.stat_result, size: int) -> tuple[int, ...]:
+    return (stat_result.st_dev, stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ctime_ns, size)
+
+
+def hash_path(path: pathlib.Path | str | bytes, size: int = 128) -> int:
+    """xxhash of the contents of path.
+
+    Large files are memory-mapped rather than copied into Python.
+    Hashes of regular files are cached by (dev, inode, size, mtime, ctime), so an unchanged file is not read again.
+    Files changed within the last couple of seconds are not cached, since a write within the same timestamp tick would not change the key.
+
+    """
+    stat_result = os.stat(path)
+    if stat.S_ISREG(stat_result.st_mode):
+        if (hash_val := _hash_cache.get(_hash_cache_key(stat_result, size))) is not None:
+            return hash_val
+    hasher = _hasher_constructor(size)()
     with open(path, "rb") as file:
-        while True:
-            buffer = file.read(block_size)
-            if not buffer:
-                break
-            hasher.update(buffer)
-    return hasher.intdigest()
+        # The file could have been replaced since we stat'ed it.
+        stat_result = os.fstat(file.fileno())
+        if not stat.S_ISREG(stat_result.st_mode):
+            # E.g., /dev/null or a pipe.
+            buffer = bytearray(_block_size)
+            view = memoryview(buffer)
+            while n_bytes := file.readinto(buffer):
+                hasher.update(view[:n_bytes])
+            return cast(int, hasher.intdigest())
+        if stat_result.st_size >= _mmap_threshold:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as contents:
+                hasher.update(contents)
+        else:
+            hasher.update(file.read())
+    hash_val = cast(int, hasher.intdigest())
+    if time.time_ns() - max(stat_result.st_mtime_ns, stat_result.st_ctime_ns) > 2 * 10**9:
+        _hash_cache.put(_hash_cache_key(stat_result, size), hash_val)
+    return hash_val
+
+
+def hash_paths(paths: Sequence[pathlib.Path | str | bytes], size: int = 128, parallelism: int = 8) -> list[int]:
+    """Like `[hash_path(path, size) for path in paths]`, but hashes in a thread pool."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallelism) as executor:
+        return list(executor.map(functools.partial(hash_path, size=size), paths))
 
 
 def expect_type(typ: type[_T] | types.UnionType, data: Any) -> _T:
@@ -134,22 +524,53 @@ def xml_to_tuple(elem: xml.etree.ElementTree.Element) -> tuple[str, Mapping[str,
     )
 
 
-def chown(path: pathlib.Path) -> None:
+def _has_foreign_owner(path: pathlib.Path, uid: int, gid: int) -> bool:
+    """Whether anything in path (recursively, not following symlinks) is not owned by uid:gid."""
+    stat = path.lstat()
+    if stat.st_uid != uid or stat.st_gid != gid:
+        return True
+    if not path.is_dir() or path.is_symlink():
+        return False
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                stat = entry.stat(follow_symlinks=False)
+                if stat.st_uid != uid or stat.st_gid != gid:
+                    return True
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(pathlib.Path(entry.path))
+    return False
+
+
+def chown(*paths: pathlib.Path) -> None:
+    """Give the current user ownership of everything in paths, which containers may have created as another user.
+
+    Usually (e.g., rootless Docker, or when we are root) there is nothing to change, which we can check in-process.
+    Otherwise, one container changes the owner of all of the paths.
+
+    """
+    uid = os.getuid()
+    gid = os.getgid()
+    paths = tuple(path for path in paths if _has_foreign_owner(path, uid, gid))
+    if not paths:
+        return
     image = "busybox"
     command = (
         "chown",
-        f"{os.getuid()}:{os.getgid()}",
+        f"{uid}:{gid}",
         "-R",
-        "/work",
+        *(f"/work/{i}" for i in range(len(paths))),
     )
     container = docker.from_env().containers.run(
         image=image,
         command=command,
         volumes={
             str(path): {
-                "bind": "/work",
+                "bind": f"/work/{i}",
                 "mode": "rw",
-            },
+            }
+            for i, path in enumerate(paths)
         },
         detach=True,
     )
@@ -158,7 +579,6 @@ def chown(path: pathlib.Path) -> None:
         raise RuntimeError(f"`docker run {shlex.join(command)}` failed with {result['StatusCode']}. See `docker logs {container.id}`")
     container.remove(force=True)
 
-
 if TYPE_CHECKING:
     def ignore_arg(obj: _T) -> _T:
         return obj
@@ -246,3 +666,30 @@ def shorten_lines(text: str, n_front_lines: int, n_back_lines: int) -> str:
             "",
             *lines[-n_back_lines:],
         ])
+
+
+def shorten_lines_stream(fileobj: IO[bytes], n_front_lines: int, n_back_lines: int) -> str:
+    """Like `shorten_lines(fileobj.read().decode(errors="backslashreplace"), ...)`, but without reading the whole file into memory.
+
+    This reads fileobj once, keeping the first n_front_lines and a window of the last n_back_lines.
+    Unlike shorten_lines, n_back_lines=0 keeps no back lines (`lines[-0:]` is all of them).
+
+    """
+    def lines() -> Iterable[bytes]:
+        # Like bytes.split(b"\n") (but keeping the newlines), so a trailing newline is followed by an empty line.
+        line = b""
+        for line in iter(fileobj.readline, b""):
+            yield line
+        if not line or line.endswith(b"\n"):
+            yield b""
+    line_iter = iter(lines())
+    front = list(itertools.islice(line_iter, n_front_lines))
+    back: collections.deque[bytes] = collections.deque(maxlen=n_back_lines)
+    n_rest_lines = 0
+    for line in line_iter:
+        back.append(line)
+        n_rest_lines += 1
+    if n_rest_lines <= n_back_lines:
+        return b"".join([*front, *back]).decode(errors="backslashreplace")
+    else:
+        return b"".join(front).decode(errors="backslashreplace") + "\n[...]\n" + b"".join(back).decode(errors="backslashreplace")
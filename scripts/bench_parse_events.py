@@ -0,0 +1,130 @@
+"""Benchmark trisovic_replication.parse_events against the original one-regex-at-a-time parser.
+
+Usage: python scripts/bench_parse_events.py [DIR]
+
+If DIR is given, every file named `stderr` under it is used as the corpus
+(RLangExecutor writes these into each script's result dir).
+Otherwise, a synthetic corpus resembling typical R stderrs is used.
+
+"""
+
+import pathlib
+import random
+import re
+import sys
+import timeit
+import warnings
+from typing import Mapping
+
+from charmonium.test_py.trisovic_replication import Event, parse_events
+
+
+def reference_parse_events(error_text: str) -> tuple[Event, ...]:
+    error_regexes = {
+        "r_error": re.compile(
+            r"Error(?: in (?P<loc>.*) )?:\s+(?P<msg>\S.*)\n\s*(?:Calls: (?P<calls>.*)\n)?(?:In addition: (?P<in_addition>.*)\nIn (?P<in_addition_loc>.*) :(?:\n  | )(?P<in_addition_msg>.*)\n)?Execution halted",
+            re.MULTILINE,
+        ),
+        "r_warnings": re.compile(
+            r"Warning messages:\n(?P<warnings>(?:\d+: In .* :\s+.*\n)*)",
+            re.MULTILINE
+        ),
+        "r_warning": re.compile(
+            r"^Warning(?: message:)?(?:\s+[Ii]n (?P<loc>.*))?\s+:\s+(?P<msg>[a-z0-9].*)",
+            re.MULTILINE
+        ),
+        "gcc_fatal_error": re.compile(
+            r"(?P<file>.*):(?P<line>\d+):(?P<col>\d+): fatal error: (?P<msg>.*)\n(?P<source>[\s\S]*)\ncompilation terminated",
+            re.MULTILINE,
+        ),
+        "configure_error": re.compile(r"(?P<configure_script>./config(?:ure|.status)): line (?P<line>\d+): (?P<msg>.*)"),
+        "make_error": re.compile(
+            r"make: \*\*\* \[(?P<makefile>.+):(?P<line>\d+): (?P<target>.*)\] Error (?P<exit_code>\d+)"
+        ),
+        "ld_error": re.compile(
+            r"(?P<ld_path>/[a-zA-Z0-9/]+/ld): (?P<msg>.*)"
+        ),
+        "r_warning_count": re.compile(r"\nThere were (?P<num_warnings>\d+) warnings"),
+        "r_other_error": re.compile(r"ERROR: '(?P<msg>.*)'"),
+        "sigkill": re.compile(r"Killed!"),
+        "install_r_package": re.compile(r"\* installing \*(?P<type>.*)\* package '(?P<package>.*)' ..."),
+        "loaded_r_package": re.compile(r"Loading required package: (?P<package>.*)"),
+    }
+
+    r_error_regexes = {
+        "no such function": re.compile(r"could not find function \"(?P<function>.*)\""),
+        "no such package": re.compile(r"there is no package called '(?P<package>.*)'"),
+        "installation of package failed": re.compile(r"installation of package '(?P<package>.*)' had non-zero exit status"),
+        "cannot open the connection": re.compile(r"cannot open the connection"),
+        "cannot open compressed file": re.compile(r"cannot open compressed file '(?P<file>.*)', probable reason '(?P<reason>.*)'"),
+        "package is not available": re.compile(r"package '(?P<package>.*)' is not available \(for R version (?P<r_ver>.*)\)"),
+    }
+
+    events: list[tuple[int, Event]] = []
+    for error_kind, error_regex in error_regexes.items():
+        for match in error_regex.finditer(error_text):
+            params = match.groupdict()
+            if error_kind == "r_warnings":
+                warnings.warn("When r_warnings are coalesced, they are also unparsed.")
+            elif error_kind == "r_error" or error_kind == "r_warning":
+                for r_error_kind, r_error_regex in r_error_regexes.items():
+                    if (match2 := r_error_regex.search(match.group("msg"))) is not None:
+                        for key, val in match2.groupdict().items():
+                            params[key] = val
+                        params["subkind"] = r_error_kind
+                        del params["msg"]
+                        break
+            events.append((match.start(), Event(error_kind, params)))
+    events.sort(key=lambda start_event: start_event[0])
+    return tuple(event for _, event in events)
+
+
+snippets: Mapping[str, str] = {
+    "loaded": "Loading required package: {package}\n",
+    "attached": "\nAttaching package: '{package}'\n\nThe following objects are masked from 'package:stats':\n\n    filter, lag\n\n",
+    "no_package": "Error in library({package}) : there is no package called '{package}'\nExecution halted\n",
+    "no_function": "Error in {package}_fit(x) : could not find function \"{package}_fit\"\nCalls: main -> {package}_fit\nExecution halted\n",
+    "connection": "Error in file(file, \"rt\") : cannot open the connection\nCalls: read.csv -> read.table -> file\nIn addition: Warning message:\nIn file(file, \"rt\") :\n  cannot open file 'data.csv': No such file or directory\nExecution halted\n",
+    "warning": "Warning message:\nIn mean.default(x) : argument is not numeric or logical: returning NA\n",
+    "warnings": "Warning messages:\n1: In log(x) : NaNs produced\n2: In sqrt(y) : NaNs produced\n",
+    "install": "* installing *source* package '{package}' ...\n** package '{package}' successfully unpacked and MD5 sums checked\n** using staged installation\n** libs\n",
+    "gcc": "gcc -I\"/usr/share/R/include\" -DNDEBUG -fpic -g -O2 -c {package}.c -o {package}.o\n{package}.c:3:10: fatal error: gsl/gsl_rng.h: No such file or directory\n    3 | #include <gsl/gsl_rng.h>\n      |          ^~~~~~~~~~~~~~~\ncompilation terminated.\n",
+    "make": "make: *** [/usr/lib/R/etc/Makeconf:168: {package}.o] Error 1\nERROR: compilation failed for package '{package}'\n",
+    "output": "[1] \"Fitting model {package}\"\n   user  system elapsed \n  0.120   0.004   0.125 \n",
+}
+
+
+def synthetic_corpus(n: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    packages = ["ggplot2", "dplyr", "lme4", "foreign", "stargazer", "sandwich", "rgdal", "haven"]
+    kinds = list(snippets.keys())
+    return [
+        "".join(
+            snippets[rng.choice(kinds)].format(package=rng.choice(packages))
+            for _ in range(rng.randint(1, 40))
+        )
+        for _ in range(n)
+    ]
+
+
+def main() -> None:
+    if len(sys.argv) > 1:
+        corpus = [
+            path.read_bytes().decode(errors="backslashreplace")
+            for path in pathlib.Path(sys.argv[1]).glob("**/stderr")
+        ]
+    else:
+        corpus = synthetic_corpus(2000)
+    print(f"{len(corpus)} stderrs, {sum(map(len, corpus)) / 1024**2:.1f}MiB")
+
+    warnings.simplefilter("ignore")
+    for text in corpus:
+        assert parse_events(text) == reference_parse_events(text), text
+
+    for name, func in [("reference", reference_parse_events), ("parse_events", parse_events)]:
+        seconds = min(timeit.repeat(lambda: list(map(func, corpus)), number=1, repeat=3))
+        print(f"{name:>15s}: {seconds:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
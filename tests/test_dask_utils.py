@@ -0,0 +1,39 @@
+import pathlib
+import warnings
+
+import charmonium.cache
+import pytest
+
+from charmonium.test_py.dask_utils import call_if_cached, call_many_if_cached
+
+
+@pytest.mark.parametrize("fine_grain_persistence", [False, True])
+def test_call_many_if_cached_agrees_with_call_if_cached(tmp_path: pathlib.Path, fine_grain_persistence: bool) -> None:
+    group = charmonium.cache.MemoizedGroup(
+        size="10MiB",
+        obj_store=charmonium.cache.DirObjStore(path=tmp_path / "cache"),
+        fine_grain_persistence=fine_grain_persistence,
+        temporary=True,
+    )
+
+    @charmonium.cache.memoize(group=group)
+    def in_obj_store(x: int, y: str = "") -> list[int]:
+        return [x] * 1000 + [len(y)]
+
+    with warnings.catch_warnings():
+        # About the unbounded cache, which is fine for a test.
+        warnings.simplefilter("ignore")
+        @charmonium.cache.memoize(group=group, use_obj_store=False)
+        def in_index(x: int, y: str = "") -> list[int]:
+            return [x, len(y)]
+
+    arg_tuples = [(x, str(x) * x) for x in range(20)]
+    for func in [in_obj_store, in_index]:
+        for args in arg_tuples[::3]:
+            func(*args)
+        expected = [call_if_cached(func, *args) for args in arg_tuples]
+        assert [hit for hit, _ in expected] == [n_args % 3 == 0 for n_args in range(len(arg_tuples))]
+        assert [value for hit, value in expected if hit] == [func(*args) for args in arg_tuples[::3]]
+        assert call_many_if_cached(func, arg_tuples, parallelism=4) == expected
+        assert call_many_if_cached(func, arg_tuples[:1]) == expected[:1]
+        assert call_many_if_cached(func, []) == []
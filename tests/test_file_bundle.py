@@ -0,0 +1,89 @@
+import os
+import pathlib
+import subprocess
+
+import pytest
+import xxhash
+
+from charmonium.test_py.analyses import file_bundle
+from charmonium.test_py.analyses.file_bundle import BlobStore, File, FileBundle
+
+
+@pytest.fixture
+def data_path(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> pathlib.Path:
+    monkeypatch.setattr(file_bundle, "config_data_path", lambda: tmp_path / "data")
+    return tmp_path / "data"
+
+
+def make_files(root: pathlib.Path) -> dict[pathlib.Path, bytes]:
+    files = {
+        # Incompressible and larger than file_bundle._chunk_size, so frames and offsets span several chunks.
+        pathlib.Path("a.bin"): os.urandom(3 * 1024**2),
+        pathlib.Path("b.txt"): b"hello\n" * 1000,
+        pathlib.Path("c.bin"): os.urandom(2 * 1024**2 + 1),
+        pathlib.Path("d/e.txt"): b"world\n",
+        pathlib.Path("d/empty"): b"",
+    }
+    for path, contents in files.items():
+        (root / path).parent.mkdir(parents=True, exist_ok=True)
+        (root / path).write_bytes(contents)
+    return files
+
+
+def test_archive_round_trip(tmp_path: pathlib.Path, data_path: pathlib.Path) -> None:
+    src = tmp_path / "src"
+    files = make_files(src)
+    bundle = FileBundle._to_archive(src, sorted(files), frame_size=4 * 1024**2, parallelism=2)
+    assert bundle.archive is not None and bundle.archive.url is not None and bundle.archive_members is not None
+    assert bundle.archive.url.parent == data_path / "archives"
+    assert bundle.archive.hash_val == xxhash.xxh64(bundle.archive.url.read_bytes()).intdigest()
+    assert bundle.archive.size == bundle.archive.url.stat().st_size
+    assert len({member.frame_offset for member in bundle.archive_members.values()}) == 2
+    assert max(member.frame_size for member in bundle.archive_members.values()) > file_bundle._chunk_size
+    assert bundle.archive_members[pathlib.Path("c.bin")].data_offset > file_bundle._chunk_size
+
+    for path, contents in files.items():
+        assert bundle.files[path].size == len(contents)
+        assert bundle.files[path].hash_val == xxhash.xxh64(contents).intdigest()
+        assert bundle.read_member(path) == contents
+
+    # Concatenated frames are one zstd stream, and one tar archive.
+    dst = tmp_path / "dst"
+    dst.mkdir()
+    subprocess.run(["tar", "--zstd", "--extract", f"--file={bundle.archive.url}", f"--directory={dst}"], check=True)
+    assert {path.relative_to(dst) for path in dst.rglob("*") if path.is_file()} == set(files)
+    for path, contents in files.items():
+        assert (dst / path).read_bytes() == contents
+
+
+def test_move(tmp_path: pathlib.Path, data_path: pathlib.Path) -> None:
+    src = tmp_path / "src"
+    files = make_files(src)
+    bundle = FileBundle.from_path(src, move=True)
+    assert bundle.archive is not None and bundle.archive.url is not None
+    remote_dir = bundle.archive.url.parent
+    assert remote_dir.parent == data_path / "moved"
+    assert set(bundle.archive.url.read_text().split("\n")) == set(map(str, files))
+    for path, contents in files.items():
+        assert not (src / path).exists()
+        assert (remote_dir / path).read_bytes() == contents
+        assert bundle.files[path].read_bytes() == contents
+        assert bundle.files[path].url == remote_dir / path
+
+
+def test_from_paths_urls(tmp_path: pathlib.Path) -> None:
+    files = make_files(tmp_path)
+    paths = [tmp_path / path for path in files]
+    assert [file.url for file in File.from_paths(paths)] == [file.url for file in map(File.from_path, paths)] == paths
+    urls = [pathlib.Path("/elsewhere") / path for path in files]
+    assert [file.url for file in File.from_paths(paths, urls)] == urls
+
+
+def test_blob_store_root_is_absolute(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    blob_store = BlobStore(pathlib.Path("blobs"))
+    assert blob_store.root == tmp_path / "blobs"
+    blob = blob_store.put(1, b"contents")
+    assert blob.is_absolute()
+    monkeypatch.chdir("/")
+    assert blob.read_bytes() == b"contents"
@@ -0,0 +1,60 @@
+import datetime
+import sys
+import time
+
+import psutil
+
+from charmonium.test_py.analyses.measure_command_execution import HeadTailBuffer, measure_command_execution
+
+
+def test_timeout_kills_backgrounded_grandchild() -> None:
+    start = time.monotonic()
+    process = measure_command_execution(
+        ("sh", "-c", "sleep 8 & sleep 8"),
+        wall_time_limit=datetime.timedelta(seconds=1),
+    )
+    assert time.monotonic() - start < 4
+    assert process.exit_code == 124
+
+
+def test_timeout_kills_lingering_grandchild() -> None:
+    # The command exits by itself, but its child keeps stdout open.
+    start = time.monotonic()
+    process = measure_command_execution(
+        ("sh", "-c", "sleep 8 &"),
+        wall_time_limit=datetime.timedelta(seconds=1),
+    )
+    assert time.monotonic() - start < 4
+    assert process.exit_code == 0
+
+
+def test_drains_more_than_pipe_buffer() -> None:
+    size = 1024 * 1024
+    process = measure_command_execution(
+        ("sh", "-c", f"head -c {size} /dev/zero; head -c {size} /dev/zero >&2"),
+        wall_time_limit=datetime.timedelta(seconds=10),
+    )
+    assert process.exit_code == 0
+    assert process.stdout_b == b"\0" * size
+    assert process.stderr_b == b"\0" * size
+
+
+def test_rss_excludes_parent() -> None:
+    mib = 1024 * 1024
+    ballast = bytearray(64 * mib)
+    ballast[::4096] = b"x" * len(ballast[::4096])
+    parent_rss = psutil.Process().memory_info().rss
+    baseline = measure_command_execution((sys.executable, "-c", "pass")).resource.max_resident_set_size
+    # The child is a fresh interpreter, so it should be nowhere near the parent's size with its ballast.
+    assert baseline < parent_rss - len(ballast) // 2
+    # The peak RSS is sampled, so the child stays alive long enough to be seen.
+    process = measure_command_execution((sys.executable, "-c", f"x = bytearray({32 * mib}); x[::4096] = b'x' * len(x[::4096]); import time; time.sleep(0.5)"))
+    assert 24 * mib < process.resource.max_resident_set_size - baseline < 48 * mib
+    del ballast
+
+
+def test_head_tail_buffer_cuts_at_characters() -> None:
+    buffer = HeadTailBuffer(8)
+    buffer.write("€€€€€€".encode())
+    value = buffer.getvalue().decode()
+    assert value == "€\n[... 12 bytes omitted ...]\n€"
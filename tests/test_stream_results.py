@@ -0,0 +1,110 @@
+import collections
+import itertools
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+import pytest
+
+from charmonium.test_py import main
+
+
+class FakeFuture:
+    def __init__(self, result: Any) -> None:
+        self._result = result
+
+    def result(self) -> Any:
+        return self._result
+
+
+class FakeClient:
+    def submit(self, func: Callable[..., Any], *args: Any) -> FakeFuture:
+        return FakeFuture(func(*args))
+
+
+class FakeAsCompleted:
+    """Completes futures in the order they were added, and records how many were outstanding."""
+
+    instances: list["FakeAsCompleted"] = []
+
+    def __init__(self, futures: Iterable[FakeFuture], with_results: bool) -> None:
+        assert with_results
+        self.queue = collections.deque(futures)
+        self.max_in_flight = 0
+        self.n_added = 0
+        FakeAsCompleted.instances.append(self)
+
+    def add(self, future: FakeFuture) -> None:
+        self.queue.append(future)
+        self.n_added += 1
+        self.max_in_flight = max(self.max_in_flight, len(self.queue))
+
+    def __iter__(self) -> Iterator[tuple[FakeFuture, Any]]:
+        while self.queue:
+            future = self.queue.popleft()
+            yield future, future.result()
+
+
+def is_cached(code: str, condition: str, iteration: int) -> bool:
+    return iteration == 0 and code in {"code0", "code2"}
+
+
+def run_stream_results(
+        monkeypatch: pytest.MonkeyPatch,
+        max_in_flight: Optional[int],
+        probe_cache: bool = True,
+        probe_batch_size: Optional[int] = None,
+) -> tuple[list[tuple[Any, ...]], list[int], FakeAsCompleted]:
+    probe_sizes: list[int] = []
+    def call_many_if_cached(func: Any, arg_tuples: list[tuple[Any, ...]]) -> list[tuple[bool, Any]]:
+        probe_sizes.append(len(arg_tuples))
+        return [
+            (True, ("cached", code, condition, iteration)) if is_cached(code, condition, iteration) else (False, None)
+            for reduction, analysis, code, condition, iteration in arg_tuples
+        ]
+    def reduced_analysis(reduction: Any, analysis: Any, code: str, condition: str, iteration: int) -> Any:
+        assert not (probe_cache and is_cached(code, condition, iteration)), "hits should not be submitted"
+        return ("computed", code, condition, iteration)
+    FakeAsCompleted.instances = []
+    monkeypatch.setattr(main, "get_codes", lambda registry: registry)
+    monkeypatch.setattr(main, "call_many_if_cached", call_many_if_cached)
+    monkeypatch.setattr(main, "reduced_analysis", reduced_analysis)
+    monkeypatch.setattr(main.distributed, "as_completed", FakeAsCompleted)
+    experimental_config = main.Config(
+        registries=([f"code{n_code}" for n_code in range(5)],),  # type: ignore
+        conditions=("condition0", "condition1"),  # type: ignore
+        analysis=None,  # type: ignore
+        reduction=None,  # type: ignore
+        n_repetitions=3,
+    )
+    n_futures, results = main.stream_results(
+        FakeClient(),  # type: ignore
+        experimental_config,
+        randomize_dispatch_order=True,
+        max_in_flight=max_in_flight,
+        probe_cache=probe_cache,
+        probe_batch_size=probe_batch_size,
+    )
+    assert n_futures == 5 * 2 * 3
+    results_list = list(results)
+    assert len(FakeAsCompleted.instances) == 1
+    return results_list, probe_sizes, FakeAsCompleted.instances[0]
+
+
+def test_stream_results_windowing(monkeypatch: pytest.MonkeyPatch) -> None:
+    jobs = set(itertools.product([f"code{n_code}" for n_code in range(5)], ["condition0", "condition1"], range(3)))
+    n_hits = sum(is_cached(*job) for job in jobs)
+    for max_in_flight, probe_batch_size in [(4, None), (4, 7), (1, 1), (100, None), (None, None)]:
+        results, probe_sizes, futures = run_stream_results(monkeypatch, max_in_flight, probe_batch_size=probe_batch_size)
+        assert len(results) == len(jobs)
+        assert {(code, condition, iteration) for code, condition, iteration, _ in results} == jobs
+        for code, condition, iteration, result in results:
+            assert result == ("cached" if is_cached(code, condition, iteration) else "computed", code, condition, iteration)
+        assert futures.n_added == len(jobs) - n_hits
+        assert futures.max_in_flight == min(max_in_flight or len(jobs), len(jobs) - n_hits)
+        assert sum(probe_sizes) == len(jobs)
+        assert max(probe_sizes) <= (probe_batch_size or max_in_flight or len(jobs))
+
+    results, probe_sizes, futures = run_stream_results(monkeypatch, 4, probe_cache=False)
+    assert probe_sizes == []
+    assert futures.n_added == len(jobs)
+    assert futures.max_in_flight == 4
+    assert {result[0] for _, _, _, result in results} == {"computed"}
@@ -0,0 +1,100 @@
+import datetime
+import itertools
+from typing import cast
+
+import pandas  # type: ignore
+
+from charmonium.test_py.analyses import WorkflowExecution
+from charmonium.test_py.codes import DataverseDataset, WorkflowCode
+from charmonium.test_py.conditions import CodeCleaning, TrisovicCondition
+from charmonium.test_py.trisovic_replication import (
+    ExecutionClass,
+    MyReducedResult,
+    ResultTables,
+    ScriptResult,
+    aggregate_scripts,
+)
+
+
+def groupby_apply_aggregates(script_df: pandas.DataFrame) -> tuple[pandas.DataFrame, pandas.DataFrame]:
+    """The per-script aggregates as status_update computed them before ResultTables and aggregate_scripts."""
+    def best(execution_classes: pandas.Series) -> ExecutionClass:
+        return (
+            ExecutionClass.success if (execution_classes == ExecutionClass.success).any() else
+            ExecutionClass.timed_out if (execution_classes == ExecutionClass.timed_out).any() else
+            ExecutionClass.failure if (execution_classes == ExecutionClass.failure).any() else
+            ExecutionClass.unknown
+        )
+    script_df = script_df.assign(execution_class=script_df["result"].map(lambda obj: obj.execution_class))
+    groups = script_df.groupby(["r_version", "code_cleaning", "code", "script"], sort=False)
+    script_agg_iterations_df = pandas.DataFrame()
+    script_agg_iterations_df["n_observations"] = groups["result"].apply(len)
+    script_agg_iterations_df["deterministic"] = groups["result"].apply(
+        lambda results: results.apply(lambda result: (
+            result.exit_code,
+            "\n".join(result.stdout.split("\n")[-5:]),
+            "\n".join(result.stderr.split("\n")[-5:]),
+        )).nunique() == 1
+    )
+    script_agg_iterations_df["execution_class"] = groups["execution_class"].apply(best)
+    script_agg_r_version_df = pandas.DataFrame()
+    script_agg_r_version_df["execution_class"] = (
+        script_agg_iterations_df
+        .reset_index()
+        .groupby(["code_cleaning", "code", "script"], sort=False)  # NOT r_version
+        ["execution_class"]
+        .apply(best)
+    )
+    return script_agg_iterations_df, script_agg_r_version_df
+
+
+def assert_same_aggregates(actual: pandas.DataFrame, expected: pandas.DataFrame) -> None:
+    assert actual.index.tolist() == expected.index.tolist()
+    assert list(actual.index.names) == list(expected.index.names)
+    for column in expected.columns:
+        assert list(actual[column]) == list(expected[column]), column
+
+
+def test_result_tables_match_groupby_apply() -> None:
+    result_tables = ResultTables()
+    outcomes = [
+        (0, "ok\n", ""),
+        (1, "", "Error in library(x)\n"),
+        (124, "", ""),
+        (1, "", "Error in eval(x)\n"),
+    ]
+    idx = itertools.count()
+    for iteration, r_version, code_cleaning, n_code in itertools.product(
+            range(3),
+            ["4.0.2", "3.6.0"],
+            [CodeCleaning.none, CodeCleaning.grayson],
+            range(3),
+    ):
+        code = WorkflowCode(DataverseDataset(f"doi:10.7910/DVN/{n_code}"), "r")
+        condition = TrisovicCondition(
+            r_version=r_version,
+            code_cleaning=code_cleaning,
+            wall_time_limit=datetime.timedelta(hours=1),
+            per_script_wall_time_limit=datetime.timedelta(hours=0.3),
+            mem_limit=1024**3,
+        )
+        if n_code == 2 and iteration == 1:
+            result_tables.append(next(idx), code, condition, RuntimeError("runner failed"))
+            continue
+        script_results = {
+            # Varies across iterations and conditions, so groups mix execution classes.
+            f"script{n_script}.R": ScriptResult(*outcomes[(n_code + 2 * n_script + iteration * (n_code + 1) + (r_version == "3.6.0")) % len(outcomes)], ())
+            for n_script in range(2)
+        }
+        result = MyReducedResult(cast(WorkflowExecution, None), script_results, ())
+        result_tables.append(next(idx), code, condition, result)
+
+    doi_df, script_df, *incremental = result_tables.snapshot()
+    assert len(doi_df) == 3 * 2 * 2 * 3
+    assert set(doi_df["experimental_status"]) >= {"exception in runner"}
+    expected = groupby_apply_aggregates(script_df)
+    # Some scripts must actually be nondeterministic, or deterministic would be vacuous.
+    assert not expected[0]["deterministic"].all()
+    for actual in [incremental, aggregate_scripts(script_df)]:
+        assert_same_aggregates(actual[0], expected[0])
+        assert_same_aggregates(actual[1], expected[1])
@@ -0,0 +1,59 @@
+import datetime
+import os
+import pathlib
+import pickle
+import subprocess
+import sys
+from typing import Hashable
+
+import charmonium.freeze
+
+from charmonium.test_py.analyses import ExecuteWorkflow
+from charmonium.test_py.codes import DataverseDataset, WorkflowCode
+from charmonium.test_py.conditions import CodeCleaning, TrisovicCondition
+from charmonium.test_py.config import memoized_group
+from charmonium.test_py.trisovic_replication import MyReduction
+from charmonium.test_py.types import Fingerprinted
+
+
+def fingerprinted_objects() -> list[Fingerprinted]:
+    return [
+        WorkflowCode(DataverseDataset("doi:10.7910/DVN/A"), "r"),
+        WorkflowCode(DataverseDataset("doi:10.7910/DVN/B"), "r"),
+        TrisovicCondition(
+            r_version="4.2.2",
+            code_cleaning=CodeCleaning.grayson,
+            wall_time_limit=datetime.timedelta(hours=1),
+            per_script_wall_time_limit=datetime.timedelta(hours=0.3),
+            mem_limit=1024**3,
+        ),
+        ExecuteWorkflow(),
+        MyReduction(),
+    ]
+
+
+def fingerprints(objs: list[Fingerprinted]) -> list[Hashable]:
+    return [charmonium.freeze.freeze(obj, memoized_group()._freeze_config) for obj in objs]
+
+
+def test_fingerprints_are_stable_across_processes() -> None:
+    objs = fingerprinted_objects()
+    expected = fingerprints(objs)
+    assert len(set(expected)) == len(expected)
+    # The second time uses the fingerprints cached on the instances.
+    assert fingerprints(objs) == expected
+    assert fingerprints([pickle.loads(pickle.dumps(obj)) for obj in objs]) == expected
+    # Each process hashes strings differently, which must not leak into the fingerprints.
+    for hash_seed in ["0", "1"]:
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import test_types; print(repr(test_types.fingerprints(test_types.fingerprinted_objects())))",
+            ],
+            env={**os.environ, "PYTHONHASHSEED": hash_seed, "PYTHONPATH": os.pathsep.join([str(pathlib.Path(__file__).parent), *sys.path])},
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        assert output.strip().split("\n")[-1] == repr(expected)
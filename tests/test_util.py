@@ -0,0 +1,169 @@
+import datetime
+import io
+import itertools
+import os
+import pathlib
+import time
+
+import pytest
+import xxhash
+
+from charmonium.test_py import util
+from charmonium.test_py.util import Reaper, hash_path, hash_paths, scan_files, shorten_lines, shorten_lines_stream
+
+
+def test_temp_dirs_stay_in_own_subdirectory() -> None:
+    assert util.temp_dir_root.parent == util.tmp_root
+    assert util.temp_dir_pool.root == util.temp_dir_root
+    assert util.reaper.trash.parent == util.temp_dir_root
+    assert all(root == util.temp_dir_root for root in util.reaper.orphan_roots)
+
+
+def test_reaper_leaves_foreign_entries_alone(tmp_path: pathlib.Path) -> None:
+    # Same layout as util.reaper, with tmp_path playing the shared tmp_root.
+    root = tmp_path / "charmonium-test-py"
+    foreign = tmp_path / "abcdefghij-klmnopqrst"
+    foreign.mkdir()
+    (foreign / "important.txt").write_text("keep me")
+    unrelated = root / "not-ours"
+    unrelated.mkdir(parents=True)
+    orphan = root / "abcdefghij-klmnopqrst"
+    orphan.mkdir()
+    (orphan / "junk").write_text("")
+
+    reaper = Reaper(root / ".trash", orphan_roots=(root,))
+    reaper.owned_name()
+    reaper._reap_orphans()
+
+    assert (foreign / "important.txt").read_text() == "keep me"
+    assert unrelated.exists()
+    assert not orphan.exists()
+
+
+def test_reaper_spares_live_owners(tmp_path: pathlib.Path) -> None:
+    root = tmp_path / "charmonium-test-py"
+    root.mkdir()
+    live_reaper = Reaper(root / ".trash", orphan_roots=(root,))
+    live = root / live_reaper.owned_name()
+    live.mkdir()
+    # An owner whose lock file exists but is not held (e.g., its process crashed).
+    (root / ".trash" / ".locks" / "deadownerx").touch()
+    dead = root / "deadownerx-abcdefghij"
+    dead.mkdir()
+
+    # flock locks belong to open file descriptions, so live_reaper's lock excludes another Reaper in this process too.
+    other_reaper = Reaper(root / ".trash", orphan_roots=(root,))
+    other_reaper.owned_name()
+    other_reaper._reap_orphans()
+
+    assert live.exists()
+    assert not dead.exists()
+    assert not (root / ".trash" / ".locks" / "deadownerx").exists()
+    assert other_reaper._is_alive(live.name.partition("-")[0])
+    os.close(live_reaper._lock_fd)
+    assert not other_reaper._is_alive(live.name.partition("-")[0])
+
+
+def test_shorten_lines_stream_matches_shorten_lines() -> None:
+    texts = ["", "a", "a\n", "\n\n", "a\nb\nc", "a\nb\nc\n", "é\n€\n" * 5, "".join(f"line {i}\n" for i in range(20))]
+    for text, n_front_lines, n_back_lines in itertools.product(texts, range(4), range(1, 4)):
+        expected = shorten_lines(text, n_front_lines, n_back_lines)
+        assert shorten_lines_stream(io.BytesIO(text.encode()), n_front_lines, n_back_lines) == expected, (text, n_front_lines, n_back_lines)
+
+
+def test_shorten_lines_stream_without_back_lines() -> None:
+    text = "a\nb\nc\nd"
+    assert shorten_lines_stream(io.BytesIO(text.encode()), 2, 0) == "a\nb\n\n[...]\n"
+    assert shorten_lines_stream(io.BytesIO(text.encode()), 4, 0) == text
+    # shorten_lines keeps every line after the [...], since lines[-0:] is the whole list.
+    assert shorten_lines(text, 2, 0) == "a\nb\n\n[...]\n" + text
+
+
+def test_scan_files(tmp_path: pathlib.Path) -> None:
+    for n_dir in range(5):
+        for n_file in range(3):
+            (tmp_path / f"dir{n_dir}" / "sub").mkdir(parents=True, exist_ok=True)
+            (tmp_path / f"dir{n_dir}" / "sub" / f"file{n_file}").write_text("x" * n_file)
+    (tmp_path / "empty_dir").mkdir()
+    (tmp_path / "top").write_text("top")
+    (tmp_path / "link").symlink_to(tmp_path / "top")
+    (tmp_path / "broken_link").symlink_to(tmp_path / "nonexistent")
+    # Following this would loop forever.
+    (tmp_path / "dir0" / "loop").symlink_to(tmp_path)
+
+    entries = {entry.path: entry for entry in scan_files(tmp_path, full_path=False, parallelism=3)}
+    assert entries.keys() == {
+        *(pathlib.Path(f"dir{n_dir}/sub/file{n_file}") for n_dir in range(5) for n_file in range(3)),
+        pathlib.Path("top"),
+        pathlib.Path("link"),
+        pathlib.Path("broken_link"),
+        pathlib.Path("dir0/loop"),
+    }
+    assert entries[pathlib.Path("top")].is_file and not entries[pathlib.Path("top")].is_symlink
+    assert entries[pathlib.Path("link")].is_file and entries[pathlib.Path("link")].is_symlink
+    assert not entries[pathlib.Path("broken_link")].is_file and entries[pathlib.Path("broken_link")].is_symlink
+    assert not entries[pathlib.Path("dir0/loop")].is_file and entries[pathlib.Path("dir0/loop")].is_symlink
+    for n_file in range(3):
+        path = pathlib.Path(f"dir1/sub/file{n_file}")
+        stat = (tmp_path / path).stat()
+        assert (entries[path].size, entries[path].inode) == (n_file, stat.st_ino)
+        assert entries[path].mtime == datetime.datetime.fromtimestamp(stat.st_mtime)
+
+    assert {entry.path for entry in scan_files(tmp_path)} == {tmp_path / path for path in entries}
+    assert [entry.path for entry in scan_files(tmp_path / "top")] == [tmp_path / "top"]
+    assert list(scan_files(tmp_path / "empty_dir")) == []
+
+
+def test_hash_cache_invalidation(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(util, "_hash_cache", util._HashCache(16))
+    path = tmp_path / "file"
+    path.write_bytes(b"old contents")
+    # Files changed within the last couple of seconds are not cached.
+    assert hash_path(path, size=64) == xxhash.xxh64(b"old contents").intdigest()
+    assert util._hash_cache.get(util._hash_cache_key(path.stat(), 64)) is None
+
+    an_hour_ago = time.time() - 3600
+    os.utime(path, (an_hour_ago, an_hour_ago))
+    # os.utime changes the ctime too, so wait until the file is old enough to be cached.
+    monkeypatch.setattr(time, "time_ns", lambda: path.stat().st_ctime_ns + 10 * 10**9)
+    assert hash_path(path, size=64) == xxhash.xxh64(b"old contents").intdigest()
+    assert util._hash_cache.get(util._hash_cache_key(path.stat(), 64)) == xxhash.xxh64(b"old contents").intdigest()
+    # Poison the entry, to see when hash_path uses it.
+    util._hash_cache.put(util._hash_cache_key(path.stat(), 64), 1234)
+    assert hash_path(path, size=64) == 1234
+    assert hash_path(path, size=128) == xxhash.xxh128(b"old contents").intdigest()
+
+    # A changed mtime misses the cache.
+    os.utime(path, (an_hour_ago, an_hour_ago + 1))
+    assert hash_path(path, size=64) == xxhash.xxh64(b"old contents").intdigest()
+
+    # So does a changed size, even with the mtime put back.
+    util._hash_cache.put(util._hash_cache_key(path.stat(), 64), 1234)
+    path.write_bytes(b"new, longer contents")
+    os.utime(path, (an_hour_ago, an_hour_ago + 1))
+    assert hash_path(path, size=64) == xxhash.xxh64(b"new, longer contents").intdigest()
+
+
+def test_hash_cache_is_bounded() -> None:
+    cache = util._HashCache(2)
+    cache.put((1,), 1)
+    cache.put((2,), 2)
+    assert cache.get((1,)) == 1
+    cache.put((3,), 3)
+    # (2,) was the least recently used.
+    assert (cache.get((1,)), cache.get((2,)), cache.get((3,))) == (1, None, 3)
+
+
+def test_hash_paths(tmp_path: pathlib.Path) -> None:
+    paths: list[pathlib.Path | str | bytes] = ["/dev/null"]
+    for n_file, size in enumerate([0, 1, util._mmap_threshold - 1, util._mmap_threshold, 3 * util._mmap_threshold + 7]):
+        path = tmp_path / f"file{n_file}"
+        path.write_bytes(os.urandom(size))
+        paths.append(path)
+    paths.append(bytes(paths[-1]))
+    for size in [32, 64, 128]:
+        assert hash_paths(paths, size=size, parallelism=3) == [hash_path(path, size=size) for path in paths]
+    assert hash_paths(paths, size=64) == [
+        xxhash.xxh64(pathlib.Path(os.fsdecode(path)).read_bytes()).intdigest()
+        for path in paths
+    ]